@@ -1,48 +1,525 @@
+import os
+import struct
+import zlib
+
 import numpy as np
 import matplotlib.pyplot as plt
 
+WORD_BITS = 64
+CHUNK_CELLS = 1 << 24  # cells read at once when exporting images
+
+
 def getBinary(rule):
     # return [int(bit) for bit in f"{rule:08b}"]
     return [(rule >> i) & 1 for i in range(8)]
 
 
+def getRuleTable(rule, radius=1, colors=2, totalistic=False):
+    # Dense lookup table indexed by the neighbourhood code, the leftmost cell is the most significant digit
+    size = 2 * radius + 1
+    codes = colors ** size
+    entries = (colors - 1) * size + 1 if totalistic else codes
+    if not 0 <= rule < colors ** entries:
+        raise ValueError(f"Rule must be between 0 and {colors ** entries - 1}.")
+
+    digits = np.array([(rule // colors ** i) % colors for i in range(entries)], dtype=int)
+    if not totalistic:
+        return digits
+
+    # Totalistic rules only depend on the sum of the neighbourhood, so map every code to its digit sum
+    remaining = np.arange(codes)
+    total = np.zeros(codes, dtype=int)
+    for _ in range(size):
+        total += remaining % colors
+        remaining //= colors
+    return digits[total]
+
+
+def packRow(row):
+    # Cell j goes to bit j % 64 of word j // 64, unused bits of the last word stay 0
+    words = -(-len(row) // WORD_BITS)
+    bits = np.zeros(words * WORD_BITS, dtype=np.uint8)
+    bits[:len(row)] = row
+    return np.packbits(bits, bitorder='little').view('<u8').astype(np.uint64)
+
+
+def unpackRows(words, width):
+    # Works for a single packed row or a 2D array of packed rows
+    words = np.ascontiguousarray(words, dtype='<u8')
+    bits = np.unpackbits(words.view(np.uint8), axis=-1, bitorder='little')
+    return bits[..., :width]
+
+
+class MemmapSink:
+    # Appends rows to a raw uint8 file in chunks, the file can be read back as a np.memmap
+    def __init__(self, path, width, chunk_rows=4096):
+        self.path = path
+        self.width = width
+        self.rows = 0
+        self.buffer = np.zeros((chunk_rows, width), dtype=np.uint8)
+        self.buffered = 0
+        self.file = open(path, 'wb')
+
+    def append(self, row):
+        self.buffer[self.buffered] = row
+        self.buffered += 1
+        if self.buffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.buffer[:self.buffered].tofile(self.file)
+        self.rows += self.buffered
+        self.buffered = 0
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def open(self):
+        # Read-only view of everything written so far, nothing is loaded until it is indexed
+        if not self.file.closed:
+            self.flush()
+        return np.memmap(self.path, dtype=np.uint8, mode='r', shape=(self.rows, self.width))
+
+    def read(self, max_size=2000):
+        # Every n-th row and column, so at most max_size x max_size cells are read from disk
+        data = self.open()
+        row_step = max(1, -(-self.rows // max_size))
+        col_step = max(1, -(-self.width // max_size))
+        return np.array(data[::row_step, ::col_step])
+
+
+class ImageWriter:
+    # Writes an image row by row: .png (1 or 8 bit grayscale), .pgm (8 bit) or .pbm (1 bit)
+    def __init__(self, path, width, height, bits=8):
+        self.format = os.path.splitext(path)[1].lower()
+        if self.format == '.pbm':
+            bits = 1
+        elif self.format == '.pgm':
+            bits = 8
+        elif self.format != '.png':
+            raise ValueError(f"Unsupported image format: {path}")
+        if bits not in (1, 8):
+            raise ValueError("Bits must be 1 or 8.")
+
+        self.bits = bits
+        self.file = open(path, 'wb')
+
+        if self.format == '.png':
+            self.compressor = zlib.compressobj(6)
+            self.file.write(b'\x89PNG\r\n\x1a\n')
+            self.writeChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bits, 0, 0, 0, 0))
+        else:
+            magic = b'P4' if bits == 1 else b'P5'
+            maxval = b'' if bits == 1 else b'255\n'
+            self.file.write(magic + f'\n{width} {height}\n'.encode() + maxval)
+
+    def writeChunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def writeRows(self, pixels):
+        # pixels are 0-255 gray values (0 is black), one row per image row
+        if self.bits == 1:
+            white = pixels >= 128
+            # PBM stores 1 as black, PNG stores 1 as white
+            data = np.packbits(~white if self.format == '.pbm' else white, axis=1)
+        else:
+            data = pixels.astype(np.uint8)
+
+        if self.format == '.png':
+            # Every PNG scanline starts with its filter type, 0 is no filter
+            data = np.hstack([np.zeros((len(data), 1), dtype=np.uint8), data])
+            compressed = self.compressor.compress(data.tobytes())
+            if compressed:
+                self.writeChunk(b'IDAT', compressed)
+        else:
+            self.file.write(data.tobytes())
+
+    def close(self):
+        if self.format == '.png':
+            self.writeChunk(b'IDAT', self.compressor.flush())
+            self.writeChunk(b'IEND', b'')
+        self.file.close()
+
+
+def downsample(rows, scale):
+    # Block average over scale x scale cells, blocks at the right and bottom edge may be smaller
+    if scale == 1:
+        return rows.astype(float)
+    starts_y = np.arange(0, rows.shape[0], scale)
+    starts_x = np.arange(0, rows.shape[1], scale)
+    sums = np.add.reduceat(np.add.reduceat(rows, starts_y, axis=0, dtype=float), starts_x, axis=1)
+    counts = np.outer(np.diff(np.append(starts_y, rows.shape[0])), np.diff(np.append(starts_x, rows.shape[1])))
+    return sums / counts
+
+
+def tilePath(path, tile_row, tile_col):
+    name, extension = os.path.splitext(path)
+    return f"{name}_r{tile_row}_c{tile_col}{extension}"
+
+
+class CycleDetector:
+    # Remembers the most recent rows by their packed bytes, so a repeated row gives the transient and period
+    def __init__(self, max_rows=4096):
+        self.max_rows = max_rows
+        self.seen = {}
+        self.transient = None
+        self.period = None
+
+    def check(self, i, key):
+        first = self.seen.get(key)
+        if first is not None:
+            self.transient = first
+            self.period = i - first
+            return True
+
+        self.seen[key] = i
+        if len(self.seen) > self.max_rows:
+            del self.seen[next(iter(self.seen))]  # oldest row, dicts keep insertion order
+        return False
+
+    def cycleKeys(self):
+        # Keys of the rows of the detected cycle, in order; the oldest kept row is the cycle's first
+        keys = {i: key for key, i in self.seen.items() if i >= self.transient}
+        return [keys[self.transient + k] for k in range(self.period)]
+
+
+def fillCycle(rows, last, transient, period):
+    # rows[last] repeats rows[transient], so every later row is a copy from inside the cycle
+    later = np.arange(last + 1, len(rows))
+    rows[later] = rows[transient + (later - transient) % period]
+
+
 class CellularAutomaton1D:
-    def __init__(self, rule, width, generations):
+    grid = None  # the whole diagram, stays None when the rows go to a sink
+
+    def __init__(self, rule, width, generations, sink=None, radius=1, colors=2, totalistic=False):
         self.rule = rule
         self.width = width
         self.generations = generations
-        self.grid = np.zeros((generations, width), dtype=int)
-        self.rule_binary = getBinary(rule)
+        self.radius = radius
+        self.colors = colors
+        self.totalistic = totalistic
+        # For elementary rules this is the same as getBinary(rule)
+        self.rule_table = getRuleTable(rule, radius, colors, totalistic)
+        self.rule_binary = self.rule_table.tolist()
+        self.sink = sink
+        self.transient = None
+        self.period = None
 
-        self.grid[0, width // 2] = 1  # first generation with a single cell in the middle
+        self.initial = np.zeros(width, dtype=int)
+        self.initial[width // 2] = 1  # first generation with a single cell in the middle
 
-    def getState(self, left, center, right):
-        # Calculate the index into the rule binary (0-7)
-        index = 4 * left + 2 * center + right
-        return self.rule_binary[index]
-        # return self.rule_binary[7 - index]
+        # With a sink the rows go to disk and only the current row is kept in memory
+        if sink is None:
+            self.createGrid()
+
+    def createGrid(self):
+        self.grid = np.zeros((self.generations, self.width), dtype=int)
+        self.grid[0] = self.initial
+
+    def getNextRow(self, row):
+        # Neighbourhood code of every cell with wrap-around, then one rule_table lookup for the whole row
+        code = np.zeros_like(row)
+        for offset in range(-self.radius, self.radius + 1):
+            code = code * self.colors + np.roll(row, -offset)
+        return self.rule_table[code]
+
+    def getRowKey(self, row):
+        if self.colors == 2:
+            return np.packbits(row).tobytes()
+        return row.astype(np.uint8).tobytes()
+
+    def getKeyRow(self, key):
+        # Inverse of getRowKey
+        cells = np.frombuffer(key, dtype=np.uint8)
+        if self.colors == 2:
+            return np.unpackbits(cells)[:self.width]
+        return cells
+
+    def getRow(self, i):
+        return self.grid[i]
+
+    def stream(self, sink=None):
+        # Yields the generations one by one without keeping them
+        row = self.getRow(0) if self.sink is None else self.initial
+        for i in range(self.generations):
+            if i > 0:
+                row = self.getNextRow(row)
+            if sink is not None:
+                sink.append(row)
+            yield row
+
+    def generate(self, vectorized=True, detect_cycles=False):
+        detector = CycleDetector() if detect_cycles else None
+
+        if self.sink is not None:
+            for i, row in enumerate(self.stream(self.sink)):
+                if detector and detector.check(i, self.getRowKey(row)):
+                    self.transient, self.period = detector.transient, detector.period
+                    # The rest only repeats the cycle, its rows are written from the detector's keys
+                    cycle = [self.getKeyRow(key) for key in detector.cycleKeys()]
+                    for j in range(i + 1, self.generations):
+                        self.sink.append(cycle[(j - self.transient) % self.period])
+                    break
+            self.sink.flush()
+            return self.sink
+
+        if detector:
+            detector.check(0, self.getRowKey(self.grid[0]))
+
+        if not vectorized:
+            return self.generateScalar(detector)
 
-    def generate(self):
         for i in range(1, self.generations):
-            for j in range(self.width):
-                # Get neighboring cells with wrap-around
-                left = self.grid[i - 1, (j - 1) % self.width]
-                center = self.grid[i - 1, j]
-                right = self.grid[i - 1, (j + 1) % self.width]
+            self.grid[i] = self.getNextRow(self.grid[i - 1])
+
+            # Once a row repeats the rest of the diagram is tiled instead of simulated
+            if detector and detector.check(i, self.getRowKey(self.grid[i])):
+                self.transient, self.period = detector.transient, detector.period
+                fillCycle(self.grid, i, self.transient, self.period)
+                break
+        return self.grid
+
+    def generateScalar(self, detector=None):
+        # Reference implementation, cell by cell
+        radius = self.radius
+        colors = self.colors
+        top = colors ** (2 * radius)  # weight of the leftmost cell in the code
+
+        for i in range(1, self.generations):
+            previous = self.grid[i - 1]
 
+            # Neighbourhood code of cell 0, with wrap-around
+            code = 0
+            for offset in range(-radius, radius + 1):
+                code = code * colors + previous[offset % self.width]
+
+            for j in range(self.width):
                 # Apply rule
-                self.grid[i, j] = self.getState(left, center, right)
+                self.grid[i, j] = self.rule_binary[code]
+
+                # Slide the window: drop cell j-radius, add cell j+radius+1
+                code = (code % top) * colors + previous[(j + radius + 1) % self.width]
+
+            if detector and detector.check(i, self.getRowKey(self.grid[i])):
+                self.transient, self.period = detector.transient, detector.period
+                fillCycle(self.grid, i, self.transient, self.period)
+                break
         return self.grid
 
-    def display(self):
+    def readRows(self, start, stop):
+        if self.sink is None:
+            return self.grid[start:stop]
+        return self.sink.open()[start:stop]
+
+    def export(self, path, scale=1, bits=8, tile_size=None):
+        # Writes the diagram straight to an image file without matplotlib, reading it in chunks of rows.
+        # Cells are shown like display(): the highest state is black. With tile_size the image is split
+        # into tiles of at most tile_size x tile_size pixels, saved as name_r<row>_c<col>.ext
+        rows = self.generations if self.sink is None else self.sink.rows
+        height = -(-rows // scale)
+        width = -(-self.width // scale)
+        tile_size = tile_size or max(height, width)
+        tile_cols = -(-width // tile_size)
+
+        # A chunk is a whole number of scale blocks high and no bigger than CHUNK_CELLS
+        chunk = max(1, CHUNK_CELLS // (self.width * scale)) * scale
+        darkest = max(self.colors - 1, 1)
+        paths = []
+        writers = []
+
+        for start in range(0, rows, chunk):
+            pixels = downsample(self.readRows(start, min(start + chunk, rows)), scale)
+            pixels = np.rint(255 - 255 * pixels / darkest).astype(np.uint8)
+
+            y = start // scale
+            while len(pixels):
+                # Open the next row of tiles when this one is full
+                if not writers:
+                    tile_row = y // tile_size
+                    tile_height = min(tile_size, height - tile_row * tile_size)
+                    for tile_col in range(tile_cols):
+                        tile_width = min(tile_size, width - tile_col * tile_size)
+                        tile_path = path if tile_cols == 1 and height <= tile_size else tilePath(path, tile_row, tile_col)
+                        writers.append(ImageWriter(tile_path, tile_width, tile_height, bits))
+                        paths.append(tile_path)
+                    tile_left = (tile_row + 1) * tile_size - y
+
+                part = pixels[:tile_left]
+                for tile_col, writer in enumerate(writers):
+                    writer.writeRows(part[:, tile_col * tile_size:(tile_col + 1) * tile_size])
+                pixels = pixels[len(part):]
+                y += len(part)
+                tile_left -= len(part)
+
+                if tile_left == 0:
+                    for writer in writers:
+                        writer.close()
+                    writers = []
+
+        for writer in writers:
+            writer.close()
+        return paths
+
+    def display(self, max_size=2000):
+        # Streamed runs are shown from a downsampled read of the sink
+        grid = self.grid if self.sink is None else self.sink.read(max_size)
+
         plt.figure(figsize=(10, 10))
-        plt.imshow(self.grid, cmap='binary')
+        plt.imshow(grid, cmap='binary')
         plt.title(f"Elementary Cellular Automaton - Rule {self.rule}")
         plt.axis('off')
         plt.tight_layout()
         plt.show()
 
 
+class PackedCellularAutomaton1D(CellularAutomaton1D):
+    # Same automaton, but every generation is stored as bits in uint64 words (64 cells per word).
+    # Unlike the base class, generate() returns those words, grid unpacks them when it is asked for.
+    # With a sink the rows are streamed like in the base class, nothing is packed then
+    def createGrid(self):
+        # The bit tricks in getNextWords assume radius 1 and 2 colors
+        if self.radius != 1 or self.colors != 2:
+            raise ValueError("The packed automaton only runs radius 1 rules with 2 colors.")
+        self.words = -(-self.width // WORD_BITS)
+        self.packed = np.zeros((self.generations, self.words), dtype=np.uint64)
+
+        # Bits beyond the width in the last word must always stay 0
+        self.last_mask = np.uint64((1 << (self.width - (self.words - 1) * WORD_BITS)) - 1)
+        self.last_bit = np.uint64((self.width - 1) % WORD_BITS)
+
+        self.packed[0] = packRow(self.initial)
+
+    @property
+    def grid(self):
+        # Unpacked only on request, this is generations * width bytes
+        if self.sink is not None:
+            return None
+        return unpackRows(self.packed, self.width)
+
+    def getRow(self, i):
+        return unpackRows(self.packed[i], self.width)
+
+    def readRows(self, start, stop):
+        return unpackRows(self.packed[start:stop], self.width)
+
+    def getNextWords(self, row):
+        one = np.uint64(1)
+        top = np.uint64(WORD_BITS - 1)
+
+        # Cell width-1 and cell 0, needed for the wrap-around at both ends
+        last_cell = (row[-1] >> self.last_bit) & one
+        first_cell = row[0] & one
+
+        # Left neighbour of cell j is cell j-1: shift up by one, carry the top bit of the previous word
+        left = row << one
+        left[1:] |= row[:-1] >> top
+        left[0] |= last_cell
+
+        # Right neighbour of cell j is cell j+1: shift down by one, carry the low bit of the next word
+        right = row >> one
+        right[:-1] |= row[1:] << top
+        right[-1] |= first_cell << self.last_bit
+
+        # OR together the neighbourhood patterns (minterms) that the rule maps to 1
+        result = np.zeros_like(row)
+        for index in range(8):
+            if not self.rule_binary[index]:
+                continue
+            term = (left if index & 4 else ~left) & (row if index & 2 else ~row) & (right if index & 1 else ~right)
+            result |= term
+
+        result[-1] &= self.last_mask
+        return result
+
+    def generate(self, vectorized=True, detect_cycles=False):
+        if self.sink is not None:
+            return super().generate(vectorized, detect_cycles)
+        if not vectorized:
+            raise ValueError("The packed automaton has no scalar path, it always steps whole words.")
+
+        detector = CycleDetector() if detect_cycles else None
+        if detector:
+            detector.check(0, self.packed[0].tobytes())
+
+        for i in range(1, self.generations):
+            self.packed[i] = self.getNextWords(self.packed[i - 1])
+
+            if detector and detector.check(i, self.packed[i].tobytes()):
+                self.transient, self.period = detector.transient, detector.period
+                fillCycle(self.packed, i, self.transient, self.period)
+                break
+        return self.packed
+
+
+def getRuleTables(rules):
+    # One row of getBinary per rule, shape (rules, 8)
+    return np.array([getBinary(rule) for rule in rules], dtype=np.uint8)
+
+
+def randomInitial(count, width, density=0.5, seed=None):
+    rng = np.random.default_rng(seed)
+    return (rng.random((count, width)) < density).astype(np.uint8)
+
+
+def iterSweep(rules=range(256), initial=None, width=101, generations=70):
+    # Evolves every rule on every initial condition together, yields the (rules, initials, width) state per generation
+    rules = list(rules)
+    tables = getRuleTables(rules).ravel()
+
+    if initial is None:
+        initial = np.zeros(width, dtype=np.uint8)
+        initial[width // 2] = 1  # single cell in the middle, like CellularAutomaton1D
+    initial = np.atleast_2d(np.asarray(initial, dtype=np.uint8))
+
+    state = np.broadcast_to(initial, (len(rules),) + initial.shape).copy()
+    # Offset of each rule's 8 entries in the flattened tables
+    rule_offset = (8 * np.arange(len(rules), dtype=np.intp))[:, None, None]
+
+    yield state
+    for _ in range(1, generations):
+        index = (np.roll(state, 1, axis=-1) << 2) | (state << 1) | np.roll(state, -1, axis=-1)
+        state = np.take(tables, rule_offset + index)
+        yield state
+
+
+def sweepRules(rules=range(256), initial=None, width=101, generations=70):
+    # Full space-time diagrams, shape (rules, initials, generations, width)
+    rows = list(iterSweep(rules, initial, width, generations))
+    return np.stack(rows, axis=2)
+
+
+def sweepSummaries(rules=range(256), initial=None, width=101, generations=70):
+    # Same pass as sweepRules, but only keeps running totals and yields (rule, summary) per rule
+    rules = list(rules)
+    density_sum = None
+    previous = None
+    changes = None
+
+    for state in iterSweep(rules, initial, width, generations):
+        density = state.mean(axis=-1)
+        if density_sum is None:
+            density_sum = density.astype(float)
+            changes = np.zeros_like(density_sum)
+        else:
+            density_sum += density
+            changes += (state != previous).mean(axis=-1)
+        previous = state
+
+    steps = max(generations - 1, 1)
+    for i, rule in enumerate(rules):
+        yield rule, {
+            "final_density": density[i],
+            "mean_density": density_sum[i] / generations,
+            "mean_activity": changes[i] / steps,
+            "final_row": previous[i],
+        }
+
+
 def CellularAutomaton_1D():
     print("1D Elementary Cellular Automaton")
 
@@ -1,10 +1,19 @@
+import json
+import queue
+import threading
+import time
+import weakref
 import numpy as np
 import matplotlib
-
-matplotlib.use('TkAgg')  # better interactivity
 import matplotlib.pyplot as plt
-import random
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from itertools import permutations
 from matplotlib.widgets import Button
+from multiprocessing import Barrier, Process, Value
+from threading import BrokenBarrierError
+from multiprocessing.shared_memory import SharedMemory
 
 # Element types
 EMPTY = 0
@@ -15,19 +24,96 @@ FIRE = 4
 DARK_SMOKE = 5
 LIGHT_SMOKE = 6
 BALLOON = 7
-WATER = 8  # Water values from 8 to 15
-
-# Colors for visualization
-COLORS = {
-    EMPTY: (0.5, 0.5, 0.5),  # Gray
-    WALL: (0.0, 0.0, 0.0),  # Black
-    SAND: (0.9, 0.8, 0.2),  # Yellow
-    WOOD: (0.6, 0.3, 0.1),  # Brown
-    FIRE: (1.0, 0.0, 0.0),  # Red
-    DARK_SMOKE: (0.3, 0.3, 0.3),  # Dark Gray
-    LIGHT_SMOKE: (0.7, 0.7, 0.7),  # Light Gray
-    BALLOON: (1.0, 0.0, 1.0),  # Magenta
-}
+WATER = 8  # Water mass from 8 to 15 is kept in a separate plane
+
+# The water plane is uint16 fixed point, masses are whole WATER_UNITs so moving them is exact
+WATER_UNIT = 4096  # plane value of one unit of mass
+MIN_WATER = 8 * WATER_UNIT
+MAX_WATER = 15 * WATER_UNIT
+
+UPDATE_MODES = ["serial", "margolus"]
+
+# The world is split into square chunks, only awake chunks are updated
+CHUNK_SIZE = 32
+TILE_TIMEOUT = 60  # seconds the main process waits for the tile workers before it gives up on them
+# Smaller water mass changes do not keep a chunk awake, levelling water moves leftover units around
+WATER_TOLERANCE = 2
+
+NO_LIFETIME = 0  # the lifetime plane stores frames left + 1, so 0 means smoke that does not age yet
+NEW_LIFETIME = 255  # a random lifetime is drawn for it at the end of the frame
+
+# Move directions used by the element registry
+FALL_DIRECTIONS = [(0, 1), (-1, 1), (1, 1)]  # Down, Down-left, Down-right
+RISE_DIRECTIONS = [(0, -1), (-1, -1), (1, -1)]  # Up, Up-left, Up-right
+SIDE_DIRECTIONS = [(-1, 0), (1, 0)]  # Left, Right
+
+# Actions of the move tables, one entry per target element
+BLOCKED = 0
+MOVE = 1  # into an empty cell
+SWAP = 2  # displace the target, it takes the mover's place
+
+ROLL_RANGE = 720  # random rolls are below this, it is divisible by the number of move orders of every element
+
+
+class Element:
+    """Behaviour, look and button of one element type.
+
+    moves are groups of (dx, dy) offsets. Groups are tried in order and the offsets of a group
+    in a random order; the first one the element may enter is taken. With pick_one only the
+    first offset of that random order is tried. An element enters empty cells, and displaces
+    holds for each move group the elements it swaps places with; like reactions, those are
+    looked up on the grid as it was at the start of the frame. reactions are (dx, dy, neighbour, becomes, neighbour_becomes)
+    and are checked before moving, blocked is what the element turns into when it cannot move.
+    Elements with a lifetime range age and get a new lifetime whenever they move up. handler names
+    a CellularAutomaton2D method that replaces the generic kernel for the element.
+    """
+
+    def __init__(self, code, name, color=None, moves=(), pick_one=False, displaces=(), reactions=(),
+                 blocked=None, lifetime=None, mass=0, handler=None, button=True):
+        self.code = code
+        self.name = name
+        self.color = color
+        self.moves = [list(group) for group in moves]
+        self.pick_one = pick_one
+        self.displaces = [list(targets) for targets in displaces]  # one list per move group, may be shorter
+        self.reactions = list(reactions)
+        self.blocked = blocked
+        self.lifetime = lifetime  # (shortest, longest) in frames, inclusive
+        self.mass = mass  # water mass of a new cell, in water plane values
+        self.handler = handler
+        self.button = button
+
+
+ELEMENTS = {}  # element code -> Element
+
+
+def register_element(element):
+    """Add or replace an element type, automatons created afterwards know it"""
+    if not 0 <= element.code < 256:
+        raise ValueError(f"Element codes must fit in a byte: {element.code}")
+    # The lifetime plane stores frames left + 1 as a byte, and NEW_LIFETIME marks undrawn lifetimes
+    if element.lifetime is not None and not 1 <= element.lifetime[0] <= element.lifetime[1] < NEW_LIFETIME - 1:
+        raise ValueError(f"Lifetimes must be between 1 and {NEW_LIFETIME - 2} frames: {element.lifetime}")
+    ELEMENTS[element.code] = element
+    return element
+
+
+register_element(Element(EMPTY, "Empty", (0.5, 0.5, 0.5)))  # Gray
+register_element(Element(WALL, "Wall", (0.0, 0.0, 0.0)))  # Black
+register_element(Element(SAND, "Sand", (0.9, 0.8, 0.2),  # Yellow
+                         moves=[[(0, 1)], [(-1, 1), (1, 1)]], displaces=[[WATER]]))
+register_element(Element(WOOD, "Wood", (0.6, 0.3, 0.1),  # Brown
+                         moves=[[(0, 1)]]))
+register_element(Element(FIRE, "Fire", (1.0, 0.0, 0.0),  # Red
+                         moves=[FALL_DIRECTIONS], reactions=[(0, 1, WOOD, DARK_SMOKE, FIRE)], blocked=LIGHT_SMOKE))
+register_element(Element(DARK_SMOKE, "Dark smoke", (0.3, 0.3, 0.3),  # Dark Gray
+                         moves=[RISE_DIRECTIONS, SIDE_DIRECTIONS], lifetime=(10, 20), button=False))
+register_element(Element(LIGHT_SMOKE, "Light smoke", (0.7, 0.7, 0.7),  # Light Gray
+                         moves=[RISE_DIRECTIONS, SIDE_DIRECTIONS], lifetime=(7, 10), button=False))
+register_element(Element(BALLOON, "Balloon", (1.0, 0.0, 1.0),  # Magenta
+                         moves=[RISE_DIRECTIONS], pick_one=True, blocked=EMPTY))
+# Water is drawn in shades of its mass and moved by its own handler, moves are for the block update
+register_element(Element(WATER, "Water", moves=[[(0, 1)]], mass=MAX_WATER, handler="_update_water"))
 
 
 def get_water_color(value):
@@ -47,263 +133,1317 @@ def get_water_color(value):
     return r, g, b
 
 
-class CellularAutomaton2D:
-    def __init__(self, width, height):
-        self.width = width
-        self.height = height
-        self.grid = np.zeros((height, width), dtype=float)
-        self.next_grid = np.zeros((height, width), dtype=float)
-        self.smoke_lifetimes = {}  # Track smoke lifetimes
-        self.coordinates = []
-
-    def generate_cave(self, fill_ratio=0.45, iterations=15):
-        """Generate a cave using B678/S2345678 rule"""
-        # Initialize grid with random cells
-        for y in range(self.height):
-            for x in range(self.width):
-                # Create border walls
-                if x == 0 or x == self.width - 1 or y == 0 or y == self.height - 1:
-                    self.grid[y, x] = WALL
-                # Random fill based on ratio
-                elif random.random() < fill_ratio:
-                    self.grid[y, x] = WALL
-                else:
-                    self.grid[y, x] = EMPTY
-
-        # Apply B678/S2345678 rule for specified iterations
-        for _ in range(iterations):
-            self.next_grid = self.grid.copy()
-
-            for y in range(1, self.height - 1):
-                for x in range(1, self.width - 1):
-                    # Count neighbors
-                    neighbors = self._count_neighbors(x, y, WALL)
-
-                    # Apply B678/S2345678 rule
-                    if self.grid[y, x] == EMPTY:
-                        # Birth: B678
-                        if neighbors >= 6:
-                            self.next_grid[y, x] = WALL
-                    else:  # Cell is alive
-                        # Survival: S2345678
-                        if neighbors < 2:
-                            self.next_grid[y, x] = EMPTY
-
-            self.grid = self.next_grid.copy()
-
-    def _count_neighbors(self, x, y, element_type):
-        """Count neighbors of specified type"""
-        count = 0
-        for dy in [-1, 0, 1]:
-            for dx in [-1, 0, 1]:
-                if dx == 0 and dy == 0:
-                    continue
-                nx, ny = x + dx, y + dy
-                if (0 <= nx < self.width and 0 <= ny < self.height and
-                        int(self.grid[ny, nx]) == element_type):
-                    count += 1
-        return count
+def compile_elements(elements):
+    """Lookup tables of the generic kernel, as lists since the kernel reads single cells.
+
+    rules[element] is None for elements that never act, otherwise (handler, reactions, move
+    groups, blocked, ages). Every move group is (orders, actions), where actions[target] is
+    MOVE for empty cells, SWAP for the elements the group displaces and BLOCKED otherwise.
+    """
+    rules = [None] * 256
+    for element in elements.values():
+        if not (element.moves or element.reactions or element.handler):
+            continue
+
+        # Every group gets a digit of the random roll, so the product of the order counts must divide it
+        orders = [list(permutations(group)) for group in element.moves]
+        if element.pick_one:
+            orders = [[order[:1] for order in group] for group in orders]
+        if ROLL_RANGE % int(np.prod([len(group) for group in orders])):
+            raise ValueError(f"{element.name} has more move orders than a random roll can pick from")
+
+        groups = []
+        displaces = element.displaces + [[]] * (len(orders) - len(element.displaces))
+        for group, targets in zip(orders, displaces):
+            actions = [BLOCKED] * 256
+            actions[EMPTY] = MOVE
+            for target in targets:
+                actions[target] = SWAP
+            groups.append((group, actions))
+
+        reactions = {}
+        for dx, dy, neighbour, becomes, neighbour_becomes in element.reactions:
+            reactions.setdefault((dx, dy), {})[neighbour] = (becomes, neighbour_becomes)
+        rules[element.code] = (element.handler, [(dx, dy, table) for (dx, dy), table in reactions.items()],
+                               groups, element.blocked, element.lifetime is not None)
+    return rules
+
+
+def build_palette(water_levels):
+    """Build a uint8 RGB palette: a row per element code, then water_levels shades of water"""
+    palette = np.zeros((256 + water_levels, 3), dtype=np.uint8)  # unknown codes stay black
+    for code, element in ELEMENTS.items():
+        if element.color is not None:
+            palette[code] = np.round(np.array(element.color) * 255)
+
+    # Each shade covers an equal slice of the 8-16 water range, colored at its middle
+    for level in range(water_levels):
+        value = WATER + (level + 0.5) * 8 / water_levels
+        palette[256 + level] = np.round(np.array(get_water_color(value)) * 255)
+    return palette
+
+
+def build_lifetime_ranges():
+    """Lowest and highest lifetime per element code, for drawing lifetimes in bulk"""
+    low = np.zeros(256, dtype=np.int64)
+    high = np.zeros(256, dtype=np.int64)
+    for code, element in ELEMENTS.items():
+        if element.lifetime is not None:
+            low[code], high[code] = element.lifetime
+    return low, high
+
+
+def block_groups():
+    """Elements that fall, slide diagonally, rise and drift, and age in the block update, from the registry"""
+    falling, sliding, rising, aging = [], [], [], []
+    for code, element in ELEMENTS.items():
+        if not element.moves or element.pick_one:
+            continue  # balloons keep their own block rule
+        offsets = [offset for group in element.moves for offset in group]
+        if (0, 1) in element.moves[0]:
+            falling.append(code)
+            if (-1, 1) in offsets:
+                sliding.append(code)
+        elif (0, -1) in element.moves[0]:
+            rising.append(code)
+        if element.lifetime is not None:
+            aging.append(code)
+    return falling, sliding, rising, aging
+
+
+def is_one_of(cells, codes):
+    """Boolean mask of the cells whose element is one of codes"""
+    mask = np.zeros(cells.shape, dtype=bool)
+    for code in codes:
+        mask |= cells == code
+    return mask
+
+
+def age_smoke(elements, lifetime, rng, low, high):
+    """Draw lifetimes for new smoke, age all smoke and remove smoke whose lifetime ran out"""
+    new = lifetime == NEW_LIFETIME
+    if new.any():
+        smoke = elements[new]
+        lifetime[new] = rng.integers(low[smoke], high[smoke] + 1) + 1
+
+    expired = lifetime == 1
+    elements[expired] = EMPTY
+    lifetime[expired] = NO_LIFETIME
+
+    aging = lifetime > 1
+    lifetime[aging] -= 1
+
+
+def brush(radius):
+    """Boolean disk of the given radius, 2 * radius + 1 cells across"""
+    offsets = np.arange(-radius, radius + 1)
+    return offsets[:, None] ** 2 + offsets[None, :] ** 2 <= radius * (radius + 1)
+
+
+def changed_cells(before, after):
+    """Cells where the (elements, water, lifetime) planes differ, water only beyond WATER_TOLERANCE"""
+    diff = (before[0] != after[0]) | (before[2] != after[2])
+    # Unsigned differences wrap around, shifted by the tolerance only small changes stay small
+    diff |= (before[1] - after[1] + WATER_TOLERANCE) > 2 * WATER_TOLERANCE
+    return diff
+
+
+def drifting_cells(elements):
+    """Rising particles with an empty cell to the side.
+
+    Blocks only drift them sideways when a random bit allows it, so they may stand still for
+    several frames and still move later; their chunks must not fall asleep meanwhile.
+    """
+    rising = is_one_of(elements, block_groups()[2])
+    empty = elements == EMPTY
+    drifting = np.zeros(elements.shape, dtype=bool)
+    drifting[:, :-1] = rising[:, :-1] & empty[:, 1:]
+    drifting[:, 1:] |= rising[:, 1:] & empty[:, :-1]
+    return drifting
+
+
+def dilate_chunks(flags):
+    """Grow a chunk mask by one chunk in every direction, diagonals included"""
+    grown = flags.copy()
+    grown[1:] |= flags[:-1]
+    grown[:-1] |= flags[1:]
+    rows = grown.copy()
+    grown[:, 1:] |= rows[:, :-1]
+    grown[:, :-1] |= rows[:, 1:]
+    return grown
+
+
+def true_runs(flags):
+    """Start and stop index of every run of True values"""
+    padded = np.concatenate(([False], flags, [False])).view(np.int8)
+    return np.flatnonzero(np.diff(padded)).reshape(-1, 2).tolist()
+
+
+def union_roots(count, a, b):
+    """Root of every node of a union-find forest over count nodes joined by the edges (a, b).
+
+    Every node starts as its own tree. Each round hooks the larger root of every edge under the
+    smaller one, then pointer jumping flattens the trees until every node points at its root,
+    so a root is always the lowest node of its tree.
+    """
+    parent = np.arange(count)
+    while len(a):
+        root_a, root_b = parent[a], parent[b]
+        # Edges inside one tree never join anything again
+        joining = root_a != root_b
+        a, b, root_a, root_b = a[joining], b[joining], root_a[joining], root_b[joining]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+    return parent
+
+
+def label_regions(mask):
+    """Label the 4-connected regions of a boolean mask without a flood fill.
+
+    Cells in one row run are connected already, so union_roots joins the runs along the
+    cells they share with the runs of the next row. Returns (labels, sizes): labels is 0
+    outside the mask and 1 to n in raster order of the regions, sizes[k] is the number of
+    cells of region k and sizes[0] is 0.
+    """
+    # Runs are numbered in raster order, every mask cell gets the number of its run
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    runs = np.cumsum(starts, dtype=np.int64).reshape(mask.shape) - 1
+    count = int(runs[-1, -1]) + 1 if mask.size else 0
+
+    # Neighbouring runs of two rows touch in a row of cells, one edge for each row of them is enough
+    vertical = mask[:-1] & mask[1:]
+    a = runs[:-1][vertical]
+    b = runs[1:][vertical]
+    new = np.ones(len(a), dtype=bool)
+    new[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+    parent = union_roots(count, a[new], b[new])
+
+    # Roots point at themselves, numbering them in order gives the labels
+    roots = parent == np.arange(count)
+    region = np.cumsum(roots)[parent]
+    labels = np.zeros(mask.shape, dtype=np.int64)
+    labels[mask] = region[runs[mask]]
+    sizes = np.bincount(labels[mask], minlength=int(roots.sum()) + 1)
+    return labels, sizes
+
+
+def grow_regions(labels, passable):
+    """Grow every labelled region through the passable cells, one cell per step, until none can grow.
+
+    Returns the owner region and the distance in steps of every cell, 0 and -1 for cells never
+    reached. A cell reached by several regions in the same step goes to the highest label.
+    """
+    owner = labels.astype(np.int32)
+    distance = np.where(labels > 0, 0, -1).astype(np.int32)
+    grown = np.empty_like(owner)
+    step = 0
+    while True:
+        step += 1
+        grown.fill(0)
+        grown[1:] = owner[:-1]
+        np.maximum(grown[:-1], owner[1:], out=grown[:-1])
+        np.maximum(grown[:, 1:], owner[:, :-1], out=grown[:, 1:])
+        np.maximum(grown[:, :-1], owner[:, 1:], out=grown[:, :-1])
+        new = (grown > 0) & (owner == 0) & passable
+        if not new.any():
+            return owner, distance
+        np.copyto(owner, grown, where=new)
+        np.copyto(distance, step, where=new)
+
+
+def dig_tunnels(labels, passable):
+    """Cells to clear so that all regions of a label array become one, and the number of tunnels.
+
+    The regions grow through the passable cells until they meet, once. Then, in rounds like
+    Boruvka's algorithm, every group of joined regions takes the meeting with another group
+    that needs the fewest cells dug, and the two paths from that meeting back to both regions
+    are cleared. Each round at least halves the number of groups and only touches the meetings.
+    """
+    owner, distance = grow_regions(labels, passable)
+    width = labels.shape[1]
+
+    # Neighbouring cells owned by different regions are where two regions meet
+    a, b = [], []
+    for first, second, offset in ((owner[:, :-1], owner[:, 1:], 1), (owner[:-1], owner[1:], width)):
+        ys, xs = np.nonzero((first != second) & (first > 0) & (second > 0))
+        a.append(ys * width + xs)
+        b.append(ys * width + xs + offset)
+    a, b = np.concatenate(a), np.concatenate(b)
+    cost = distance.ravel()[a].astype(np.int64) + distance.ravel()[b]
+
+    path = np.zeros(labels.shape, dtype=bool)
+    tunnels = 0
+    group = np.arange(int(labels.max()) + 1)  # joined regions share the label of their lowest region
+    while True:
+        group_a, group_b = group[owner.ravel()[a]], group[owner.ravel()[b]]
+        # Meetings inside one group never join anything again
+        meeting = group_a != group_b
+        a, b, cost, group_a, group_b = a[meeting], b[meeting], cost[meeting], group_a[meeting], group_b[meeting]
+        if len(a) == 0:
+            break  # all joined, or the rest cannot reach each other
+
+        # Every group picks its cheapest meeting, the first one found on ties
+        key = cost * len(a) + np.arange(len(a))
+        best = np.full(len(group), np.iinfo(np.int64).max)
+        np.minimum.at(best, group_a, key)
+        np.minimum.at(best, group_b, key)
+        chosen = np.unique(best[best < np.iinfo(np.int64).max] % len(a))
+        tunnels += len(chosen)
+        group = union_roots(len(group), group_a[chosen], group_b[chosen])[group]
+
+        # Walk back from both sides of each meeting to their regions, always to a cell one step closer
+        ys, xs = np.unravel_index(np.concatenate((a[chosen], b[chosen])), labels.shape)
+        region = owner[ys, xs]
+        left = distance[ys, xs]
+        path[ys, xs] = True
+        while True:
+            walking = left > 0
+            ys, xs, region, left = ys[walking], xs[walking], region[walking], left[walking]
+            if len(ys) == 0:
+                break
+            moved = np.zeros(len(ys), dtype=bool)
+            for dy, dx in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+                ny = np.clip(ys + dy, 0, labels.shape[0] - 1)
+                nx = np.clip(xs + dx, 0, labels.shape[1] - 1)
+                closer = ~moved & (distance[ny, nx] == left - 1) & (owner[ny, nx] == region)
+                ys[closer], xs[closer] = ny[closer], nx[closer]
+                moved |= closer
+            left = left - 1
+            path[ys, xs] = True
+    return path & (labels == 0), tunnels
+
+
+def margolus_step(elements, water, lifetime, offset, bits, halo=None):
+    """Update all 2x2 blocks that start at (offset, offset) in place.
+
+    Blocks never read or write each other's cells, so each rule runs on every block at once.
+    bits holds one random byte per block. halo is the (elements, water) row just below the
+    arrays, used when the grid continues past them; without it that row counts as wall.
+    """
+    height, width = elements.shape
+    rows = (height - offset) // 2
+    cols = (width - offset) // 2
+    if rows <= 0 or cols <= 0:
+        return
+    region = (slice(offset, offset + 2 * rows), slice(offset, offset + 2 * cols))
+
+    def blocks_of(plane):
+        # View of shape (2, 2, rows, cols): blocks[dy, dx] is the cell at (dy, dx) of every block
+        return plane[region].reshape(rows, 2, cols, 2).transpose(1, 3, 0, 2)
+
+    # Work on contiguous copies, strided views are much slower to update
+    E, W, L = (np.ascontiguousarray(blocks_of(plane)) for plane in (elements, water, lifetime))
+    planes = (E, W, L)
+
+    # Masked writes and swaps use XOR with a 0/1 mask, which costs the same whatever the mask looks like.
+    # Values computed for cells outside the mask may have wrapped around, they are never written
+    def put(blocks, at, value, mask):
+        target = blocks[at]
+        diff = target ^ value
+        diff *= mask.view(np.uint8)
+        target ^= diff
+
+    def swap(mask, a, b):
+        flags = mask.view(np.uint8)
+        for blocks in planes:
+            diff = blocks[a] ^ blocks[b]
+            diff *= flags
+            blocks[a] ^= diff
+            blocks[b] ^= diff
+
+    def random_bit(k):
+        return ((bits >> k) & 1).astype(bool)
+
+    def supports(element, mass):
+        # Water only spreads sideways when it cannot flow down
+        return (element != EMPTY) & ~((element == WATER) & (mass < MAX_WATER))
+
+    # Support for the bottom row comes from the row below every block, as it was before this step
+    below_elements = np.full((rows, width), WALL, dtype=elements.dtype)
+    below_water = np.zeros((rows, width), dtype=water.dtype)
+    inside = elements[offset + 2::2][:rows]
+    below_elements[:len(inside)] = inside
+    below_water[:len(inside)] = water[offset + 2::2][:rows]
+    if len(inside) < rows and halo is not None:
+        below_elements[-1], below_water[-1] = halo
+    below_supports = [supports(below_elements[:, offset + c::2][:, :cols], below_water[:, offset + c::2][:, :cols])
+                      for c in (0, 1)]
+
+    falling, sliding, rising, aging = block_groups()
+    for c in (0, 1):
+        # Reactions with the cell below, like fire burning wood into dark smoke
+        for code, element in ELEMENTS.items():
+            for dx, dy, neighbour, becomes, neighbour_becomes in element.reactions:
+                if (dx, dy) == (0, 1):
+                    react = (E[0, c] == code) & (E[1, c] == neighbour)
+                    put(E, (1, c), neighbour_becomes, react)
+                    put(E, (0, c), becomes, react)
+
+        # Falling elements sink through the elements they displace, like sand through water
+        for code in falling:
+            for target in ELEMENTS[code].displaces[0] if ELEMENTS[code].displaces else ():
+                swap((E[0, c] == code) & (E[1, c] == target), (0, c), (1, c))
+
+        # Falling elements move into an empty cell below
+        swap(is_one_of(E[0, c], falling) & (E[1, c] == EMPTY), (0, c), (1, c))
+
+    for c in (0, 1):
+        # Sand and fire slide diagonally when the cell below is taken
+        swap(is_one_of(E[0, c], sliding) & (E[1, 1 - c] == EMPTY), (0, c), (1, 1 - c))
+
+        # Elements that could not move turn into their blocked element, fire goes out as light smoke
+        for code in sliding:
+            if ELEMENTS[code].blocked is not None:
+                put(E, (0, c), ELEMENTS[code].blocked, E[0, c] == code)
+
+    for c in (0, 1):
+        # Balloons pick straight up or the diagonal and pop if it is taken
+        balloon = E[1, c] == BALLOON
+        straight = random_bit(c)
+        up = balloon & straight & (E[0, c] == EMPTY)
+        swap(up, (1, c), (0, c))
+        diagonal = balloon & ~straight & (E[0, 1 - c] == EMPTY)
+        swap(diagonal, (1, c), (0, 1 - c))
+        put(E, (1, c), EMPTY, balloon & ~up & ~diagonal)
+
+    # Rising elements float up through the elements they displace
+    for c in (0, 1):
+        for code in rising:
+            for target in ELEMENTS[code].displaces[0] if ELEMENTS[code].displaces else ():
+                swap((E[1, c] == code) & (E[0, c] == target), (1, c), (0, c))
+
+    # Smoke rises straight up, then diagonally, and gets a new lifetime when it does
+    for diagonal in (False, True):
+        for c in (0, 1):
+            column = 1 - c if diagonal else c
+            rise = is_one_of(E[1, c], rising) & (E[0, column] == EMPTY)
+            swap(rise, (1, c), (0, column))
+            put(L, (0, column), NEW_LIFETIME, rise & is_one_of(E[0, column], aging))
+
+    for r in (0, 1):
+        # Smoke that cannot rise drifts sideways, smoke that never moved before gets a lifetime
+        drift = random_bit(2 + r) & ((is_one_of(E[r, 0], rising) & (E[r, 1] == EMPTY)) |
+                                     (is_one_of(E[r, 1], rising) & (E[r, 0] == EMPTY)))
+        swap(drift, (r, 0), (r, 1))
+        for c in (0, 1):
+            put(L, (r, c), NEW_LIFETIME, drift & (L[r, c] == NO_LIFETIME) & is_one_of(E[r, c], aging))
+
+    for c in (0, 1):
+        # Water pours its excess into water below that is not full
+        pour = (E[0, c] == WATER) & (E[1, c] == WATER) & (W[1, c] < MAX_WATER)
+        excess = W[0, c] - MIN_WATER
+        room = MAX_WATER - W[1, c]
+        fits = pour & (excess <= room)
+        partly = pour & ~fits
+        put(W, (1, c), W[1, c] + excess, fits)
+        put(E, (0, c), EMPTY, fits)
+        put(W, (0, c), 0, fits)
+        put(W, (0, c), W[0, c] - room, partly)
+        put(W, (1, c), MAX_WATER, partly)
+
+    for r in (0, 1):
+        if r == 0:
+            supported = [supports(E[1, c], W[1, c]) for c in (0, 1)]
+        else:
+            supported = below_supports
+
+        for c in (0, 1):
+            # Water spreads half of its excess into an empty side cell
+            spread = ((E[r, c] == WATER) & supported[c] & (E[r, 1 - c] == EMPTY) &
+                      (W[r, c] - MIN_WATER > WATER_UNIT // 2))
+            half = (W[r, c] - MIN_WATER) // 2  # an odd unit stays in the source
+            put(E, (r, 1 - c), WATER, spread)
+            put(W, (r, 1 - c), MIN_WATER + half, spread)
+            put(W, (r, c), W[r, c] - half, spread)
+
+        # Water next to water levels out, the right cell keeps an odd unit
+        level = (E[r, 0] == WATER) & (E[r, 1] == WATER) & (supported[0] | supported[1])
+        excess = (W[r, 0] - MIN_WATER) + (W[r, 1] - MIN_WATER)
+        put(W, (r, 0), MIN_WATER + excess // 2, level)
+        put(W, (r, 1), MIN_WATER + (excess - excess // 2), level)
+
+    for plane, blocks in ((elements, E), (water, W), (lifetime, L)):
+        view = blocks_of(plane)
+        for dy in (0, 1):
+            for dx in (0, 1):
+                view[dy, dx] = blocks[dy, dx]
+
+
+def water_supported(elements, water):
+    """Water cells that cannot flow down, the last row rests on the edge of the arrays"""
+    supported = elements == WATER
+    below_elements, below_water = elements[1:], water[1:]
+    supported[:-1] &= (below_elements != EMPTY) & ~((below_elements == WATER) & (below_water < MAX_WATER))
+    return supported
+
+
+def water_pass(elements, water, iterations):
+    """Move all water in the arrays at once, in place, for the given number of iterations.
+
+    An iteration lets water fall one cell, pour its excess into water below, spread half of its
+    excess into empty side cells, and sets every horizontal run of resting water to the run's
+    mean. Each step only moves excess mass (mass - MIN_WATER) between water cells, in whole units.
+    """
+    for _ in range(iterations):
+        # A column of water falls one cell as a whole when the first cell below it is empty.
+        # For every cell find the nearest row at or below it that is not water
+        height = elements.shape[0]
+        rows = np.arange(height)[:, None]
+        stop = np.minimum.accumulate(np.where(elements != WATER, rows, height)[::-1], axis=0)[::-1]
+        below = np.take_along_axis(elements, np.minimum(stop, height - 1), axis=0)
+        fall = (elements == WATER) & (stop < height) & (below == EMPTY)
+        mass = water[fall]
+        elements[fall] = EMPTY
+        water[fall] = 0
+        elements[1:][fall[:-1]] = WATER
+        water[1:][fall[:-1]] = mass  # the last row never falls, so the order matches
+
+        # Water pours as much excess as fits into water below, all columns and rows together
+        pour = (elements[:-1] == WATER) & (elements[1:] == WATER) & (water[1:] < MAX_WATER)
+        transfer = np.where(pour, np.minimum(water[:-1] - MIN_WATER, MAX_WATER - water[1:]), 0)
+        water[:-1] -= transfer
+        water[1:] += transfer
+        # Cells that poured all their excess and got none from above are gone
+        drained = pour & (water[:-1] == MIN_WATER)
+        elements[:-1][drained] = EMPTY
+        water[:-1][drained] = 0
+
+        # Resting water spreads half of its excess to the left, then to the right
+        for source, target in ((np.s_[:, 1:], np.s_[:, :-1]), (np.s_[:, :-1], np.s_[:, 1:])):
+            spread = (water_supported(elements, water)[source] & (elements[target] == EMPTY) &
+                      (water[source] - MIN_WATER > WATER_UNIT // 2))
+            mass = water[source][spread]
+            half = (mass - MIN_WATER) // 2  # an odd unit stays in the source
+            elements[target][spread] = WATER
+            water[target][spread] = MIN_WATER + half
+            water[source][spread] = mass - half
+
+        # Runs of resting water level out, a run is numbered by the count of run starts before it
+        resting = water_supported(elements, water)
+        starts = resting.copy()
+        starts[:, 1:] &= ~resting[:, :-1]
+        runs = np.cumsum(starts.ravel())[resting.ravel()] - 1
+        if len(runs):
+            excess = np.bincount(runs, weights=water[resting] - MIN_WATER).astype(np.int64)
+            counts = np.bincount(runs)
+            # Every cell gets the run's share, the leftover units go one each to the first cells
+            position = np.arange(len(runs)) - np.flatnonzero(starts.ravel()[resting.ravel()])[runs]
+            water[resting] = MIN_WATER + excess[runs] // counts[runs] + (position < excess[runs] % counts[runs])
+
+
+def tile_bounds(height, tiles):
+    """Top and bottom row of every horizontal tile, tops are even so tiles start on block rows"""
+    if tiles < 1 or tiles > height // 2:
+        raise ValueError(f"Cannot split {height} rows into {tiles} tiles")
+    tops = [2 * (i * height // (2 * tiles)) for i in range(tiles)]
+    return list(zip(tops, tops[1:] + [height]))
+
+
+def step_tile(elements, water, lifetime, flags, chunk_size, top, bottom, offset, rng, low, high, sync):
+    """Run one margolus frame on the tile holding rows top to bottom of shared planes.
+
+    A tile owns the blocks whose top row it holds, so a block on the border belongs to the
+    upper tile and only one process moves its particles. The row just below those blocks is
+    the lower tile's, it is copied as halo before anyone moves. sync is a barrier of all tiles.
+    flags are the changed and drifting flags of every chunk.
+    """
+    height, width = elements.shape
+    own = slice(top, bottom)
+    before = (elements[own].copy(), water[own].copy(), lifetime[own].copy())
+    blocks = slice(top + offset, min(bottom + offset, height))
+    halo = None
+    if blocks.stop < height:
+        halo = (elements[blocks.stop, offset:].copy(), water[blocks.stop, offset:].copy())
+    sync.wait()
+
+    planes = (elements[blocks, offset:], water[blocks, offset:], lifetime[blocks, offset:])
+    bits = rng.integers(0, 256, size=((blocks.stop - blocks.start) // 2, (width - offset) // 2), dtype=np.uint8)
+    margolus_step(*planes, 0, bits, halo)
+    # Blocks of the tile above may reach into the first row, wait for them before looking at it
+    sync.wait()
+
+    after = (elements[own], water[own], lifetime[own])
+    age_smoke(after[0], after[2], rng, low, high)
+    # Only True is ever written, so tiles sharing a chunk row cannot undo each other's flags
+    for chunks, cells in zip(flags, (changed_cells(before, after), drifting_cells(after[0]))):
+        ys, xs = np.nonzero(cells)
+        chunks[(ys + top) // chunk_size, xs // chunk_size] = True
+
+
+def shared_planes(memories, shape, chunk_shape):
+    """Element, water and lifetime planes and the changed and drifting chunk flags on top of shared memory blocks"""
+    return (np.ndarray(shape, dtype=np.uint8, buffer=memories[0].buf),
+            np.ndarray(shape, dtype=np.uint16, buffer=memories[1].buf),
+            np.ndarray(shape, dtype=np.uint8, buffer=memories[2].buf),
+            np.ndarray((2,) + chunk_shape, dtype=bool, buffer=memories[3].buf))
+
+
+def tile_worker(names, shape, chunk_size, top, bottom, index, seed, frame, start, sync, done):
+    """Process that steps one tile every time the main process passes the start barrier"""
+    memories = [SharedMemory(name=name) for name in names]
+    chunk_shape = (-(-shape[0] // chunk_size), -(-shape[1] // chunk_size))
+    elements, water, lifetime, flags = shared_planes(memories, shape, chunk_shape)
+    low, high = build_lifetime_ranges()
+    try:
+        while True:
+            start.wait()
+            if frame.value < 0:
+                break
+            # Random bits depend only on the frame's seed and the tile, not on timing
+            rng = np.random.default_rng([seed.value, index])
+            step_tile(elements, water, lifetime, flags, chunk_size, top, bottom, frame.value % 2,
+                      rng, low, high, sync)
+            done.wait()
+    except BaseException:
+        # Break the barriers, so the main process and the other tiles do not wait for this one forever
+        for barrier in (start, sync, done):
+            barrier.abort()
+        raise
+    finally:
+        # Views must be gone before the shared memory can be closed
+        del elements, water, lifetime, flags
+        for memory in memories:
+            memory.close()
+
+
+def release_tiles(workers, memories):
+    """Stop the tile workers that still run and free their shared memory.
+
+    Called by close() and, through weakref.finalize, when an automaton is collected or the
+    interpreter exits without close().
+    """
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
+    for memory in memories:
+        memory.unlink()
+        try:
+            memory.close()
+        except BufferError:
+            pass  # arrays still use it, the mapping goes away with the process
+
+
+def replay(path, tiles=1):
+    """Run a replay file headless and return the automaton at the frame it was saved"""
+    ca = CellularAutomaton2D.load_checkpoint(path, tiles)
+    with np.load(path) as data:
+        inputs = data["inputs"]
+        end_frame = int(data["end_frame"])
+
+    # Consecutive inputs of one element in one frame are added together. Added one by one they
+    # would give the same grid, as a cell only takes the first element that is added to it
+    starts = np.flatnonzero((np.diff(inputs[:, 0]) != 0) | (np.diff(inputs[:, 3]) != 0)) + 1
+    runs = np.split(inputs, starts) if len(inputs) else []
+
+    # Inputs are applied before the frame they were made in, like between two timer ticks
+    next_run = 0
+    while True:
+        while next_run < len(runs) and runs[next_run][0, 0] <= ca.frame:
+            run = runs[next_run]
+            ca.add_elements(run[:, 1], run[:, 2], int(run[0, 3]))
+            next_run += 1
+        if ca.frame >= end_frame:
+            return ca
+        ca.update()
 
-    def update(self):
-        """Update the grid for one generation"""
-        self.next_grid = self.grid.copy()
 
-        # Process cells in random order to avoid directional bias
-        self.coordinates = [(x, y) for y in range(self.height) for x in range(self.width)]
-        random.shuffle(self.coordinates)
+class UpdateStats:
+    """Count and time of every part of CellularAutomaton2D.update over the last window frames"""
 
-        for x, y in self.coordinates:
-            cell_type = int(self.grid[y, x])
+    def __init__(self, window=60):
+        self.frames = deque(maxlen=window)
+        self.current = {}  # name -> (count, seconds) of the frame being updated
 
-            # Skip empty cells and walls
-            if cell_type == EMPTY or cell_type == WALL:
-                continue
+    def add(self, name, seconds, count=1):
+        total_count, total_seconds = self.current.get(name, (0, 0.0))
+        self.current[name] = (total_count + count, total_seconds + seconds)
 
-            # Process each element type
-            if cell_type == SAND:
-                self._update_sand(x, y)
-            elif cell_type == WOOD:
-                self._update_wood(x, y)
-            elif cell_type == FIRE:
-                self._update_fire(x, y)
-            elif cell_type in [DARK_SMOKE, LIGHT_SMOKE]:
-                self._update_smoke(x, y, cell_type)
-            elif cell_type >= WATER:
-                self._update_water(x, y)
-            elif cell_type == BALLOON:
-                self._update_balloon(x, y)
-
-        self.grid = self.next_grid.copy()
-
-        # Update smoke lifetimes and remove expired smoke
-        expired = []
-        for pos, lifetime in self.smoke_lifetimes.items():
-            if lifetime <= 0:
-                x, y = pos
-                if (0 <= x < self.width and 0 <= y < self.height and
-                        int(self.grid[y, x]) in [DARK_SMOKE, LIGHT_SMOKE]):
-                    self.grid[y, x] = EMPTY
-                expired.append(pos)
-            else:
-                self.smoke_lifetimes[pos] -= 1
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        yield
+        self.add(name, time.perf_counter() - start)
 
-        for pos in expired:
-            del self.smoke_lifetimes[pos]
+    def end_frame(self):
+        self.frames.append(self.current)
+        self.current = {}
 
-    def _is_empty(self, x, y):
-        """Check if a cell is empty and within bounds"""
-        return (0 <= x < self.width and 0 <= y < self.height and
-                self.next_grid[y, x] == EMPTY)
+    def summary(self):
+        """Mean count and milliseconds per frame of every part, slowest first"""
+        frames = list(self.frames)  # a copy, another thread may be adding frames
+        totals = {}
+        for frame in frames:
+            for name, (count, seconds) in frame.items():
+                total_count, total_seconds = totals.get(name, (0, 0.0))
+                totals[name] = (total_count + count, total_seconds + seconds)
+        means = {name: (count / len(frames), 1000 * seconds / len(frames)) for name, (count, seconds) in totals.items()}
+        return dict(sorted(means.items(), key=lambda item: -item[1][1]))
 
-    def _is_within_bounds(self, x, y):
-        """Check if coordinates are within grid bounds"""
-        return 0 <= x < self.width and 0 <= y < self.height
+    def format(self):
+        """Summary as text lines for printing or an overlay"""
+        return "\n".join(f"{name:<12}{count:>10.1f}{ms:>9.2f} ms" for name, (count, ms) in self.summary().items())
 
-    def _update_sand(self, x, y):
-        """Update sand behavior"""
-        # Move down
-        if self._is_empty(x, y + 1):
-            self.next_grid[y, x] = EMPTY
-            self.next_grid[y + 1, x] = SAND
-
-        # Displace water below
-        elif 0 <= y + 1 < self.height and int(self.grid[y + 1, x]) >= WATER:
-            self.next_grid[y, x] = self.grid[y + 1, x]
-            self.next_grid[y + 1, x] = SAND
-            self.coordinates.remove((x, y + 1))
-
-        # Move diagonal
-        elif self._is_empty(x - 1, y + 1) or self._is_empty(x + 1, y + 1):
-            self.next_grid[y, x] = EMPTY
-
-            options = []
-            if self._is_empty(x - 1, y + 1):
-                options.append((x - 1, y + 1))
-            if self._is_empty(x + 1, y + 1):
-                options.append((x + 1, y + 1))
-
-            if options:
-                nx, ny = random.choice(options)
-                self.next_grid[ny, nx] = SAND
-
-    def _update_wood(self, x, y):
-        """Update wood behavior"""
-        # Wood falls down if there's space below
-        if self._is_empty(x, y + 1):
-            self.next_grid[y, x] = EMPTY
-            self.next_grid[y + 1, x] = WOOD
-            return  # Wood moved, stop checking for fire
 
-    def _update_fire(self, x, y):
-        """Update fire behavior"""
+class FrameRenderer:
+    def __init__(self, width, height, water_levels=64):
+        self.water_levels = water_levels
+        self.palette = build_palette(water_levels)
+        self.rgb = np.zeros((height, width, 3), dtype=np.uint8)
 
-        # Check if wood below
-        if 0 <= y + 1 < self.height and int(self.grid[y + 1, x]) == WOOD:
-            self.next_grid[y + 1, x] = FIRE
-            self.next_grid[y, x] = DARK_SMOKE
+    def render(self, elements, water, region=None):
+        """Convert the grid to RGB with one palette lookup, reusing the same output buffer.
+
+        region is a (rows, cols) pair of slices; when given only that part is redrawn.
+        """
+        if region is not None:
+            self.rgb[region] = self.palette[self._palette_index(elements[region], water[region])]
+            return self.rgb
+        np.take(self.palette, self._palette_index(elements, water), axis=0, out=self.rgb)
+        return self.rgb
+
+    def _palette_index(self, elements, water):
+        """Palette row of every cell, water gets the shade for its mass"""
+        level = (water.astype(np.intp) - MIN_WATER) * self.water_levels // (8 * WATER_UNIT)
+        np.clip(level, 0, self.water_levels - 1, out=level)
+        return np.where(elements == WATER, 256 + level, elements)
+
+
+class CellularAutomaton2D:
+    def __init__(self, width, height, seed=None, mode="serial", chunk_size=CHUNK_SIZE, tiles=1,
+                 water_iterations=0):
+        if mode not in UPDATE_MODES:
+            raise ValueError(f"Unknown update mode: {mode}")
+        if tiles > 1 and mode != "margolus":
+            raise ValueError("Tiles need the margolus mode, the serial update moves one particle at a time")
+        if chunk_size <= 0 or chunk_size % 2:
+            # Chunk corners must fall on block corners in the margolus mode
+            raise ValueError(f"Chunk size must be a positive even number: {chunk_size}")
+        if water_iterations and mode != "serial":
+            raise ValueError("The water pass replaces the serial water handler, margolus blocks move water")
+        if water_iterations > chunk_size:
+            # Water moves up to one cell per iteration and must stay next to its awake chunk
+            raise ValueError(f"At most {chunk_size} water iterations per frame with chunks of {chunk_size}")
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.water_iterations = water_iterations  # 0 moves water with the per-cell handler
+        self.frame = 0
+        self.rng = np.random.default_rng(seed)
+        # Element codes and water mass (MIN_WATER to MAX_WATER, 0 for other cells) are kept in separate planes
+        self.elements = np.zeros((height, width), dtype=np.uint8)
+        self.water = np.zeros((height, width), dtype=np.uint16)
+        self.lifetime = np.zeros((height, width), dtype=np.uint8)  # smoke lifetimes, move with the smoke
+        # Only the serial update writes a next grid, blocks are updated in place. That is 4 bytes a
+        # cell for the block update and 9 for the serial one
+        self.next_elements = self.next_water = self.next_lifetime = self.processed = None
+        if mode == "serial":
+            self.next_elements = np.zeros((height, width), dtype=np.uint8)
+            self.next_water = np.zeros((height, width), dtype=np.uint16)
+            self.next_lifetime = np.zeros((height, width), dtype=np.uint8)
+            self.processed = np.zeros((height, width), dtype=bool)  # cells already handled this frame
+        self.lifetime_low, self.lifetime_high = build_lifetime_ranges()
+        self.rules = compile_elements(ELEMENTS)  # element behaviour as lookup tables
+        # Update function of every element code, called with (x, y); None for elements that never act
+        self.kernels = [None if rule is None else
+                        getattr(self, rule[0]) if rule[0] is not None else
+                        partial(self._update_element, code, *rule[1:])
+                        for code, rule in enumerate(self.rules)]
+        self.rolls = iter(())  # one random roll per scheduled particle, drawn each frame
+        self.recording = None  # state at the start of the replay log, None when not recording
+        self.inputs = []  # (frame, x, y, element) of every added cell while recording, single or in arrays
+        self.stats = None  # UpdateStats while instrumentation is enabled
+
+        # A chunk sleeps once neither it nor a neighbour changed for sleep_frames frames. Margolus
+        # blocks alternate, so there a particle can stay still for one frame and move in the next
+        self.chunk_size = chunk_size
+        chunk_shape = (-(-height // chunk_size), -(-width // chunk_size))
+        self.sleep_frames = 2 if mode == "margolus" else 1
+        self.quiet = np.zeros(chunk_shape, dtype=np.uint8)  # frames since the chunk or a neighbour changed
+        self.changed = np.ones(chunk_shape, dtype=bool)  # chunks changed by the last frame
+        self.painted = np.ones(chunk_shape, dtype=bool)  # chunks painted into since then
+
+        self.workers = []
+        if tiles > 1:
+            self._start_tiles(tiles)
+
+    def _start_tiles(self, tiles):
+        """Move the planes into shared memory and start one worker process per horizontal tile"""
+        bounds = tile_bounds(self.height, tiles)
+        planes = (self.elements, self.water, self.lifetime, np.zeros((2,) + self.changed.shape, dtype=bool))
+        self.shared = [SharedMemory(create=True, size=max(plane.nbytes, 1)) for plane in planes]
+        shared = shared_planes(self.shared, self.elements.shape, self.changed.shape)
+        for source, target in zip(planes, shared):
+            target[:] = source
+        self.elements, self.water, self.lifetime, self.tile_flags = shared
+
+        self.tile_frame = Value('q', 0, lock=False)
+        self.tile_seed = Value('q', 0, lock=False)
+        self.tile_start = Barrier(tiles + 1)
+        self.tile_done = Barrier(tiles + 1)
+        sync = Barrier(tiles)
+        names = [memory.name for memory in self.shared]
+        for index, (top, bottom) in enumerate(bounds):
+            worker = Process(target=tile_worker, daemon=True,
+                             args=(names, self.elements.shape, self.chunk_size, top, bottom, index, self.tile_seed,
+                                   self.tile_frame, self.tile_start, sync, self.tile_done))
+            worker.start()
+            self.workers.append(worker)
+        self.release = weakref.finalize(self, release_tiles, self.workers, self.shared)
+
+    def close(self):
+        """Stop the tile workers and move the planes out of shared memory"""
+        if not self.workers:
             return
+        self.tile_frame.value = -1
+        try:
+            self.tile_start.wait(TILE_TIMEOUT)
+        except BrokenBarrierError:
+            pass  # a worker failed, release_tiles stops the rest
+        for worker in self.workers:
+            worker.join(TILE_TIMEOUT)
+        self._release_tiles()
+
+    def _release_tiles(self):
+        """Move the planes out of shared memory, then free it and stop the workers that still run"""
+        self.elements = self.elements.copy()
+        self.water = self.water.copy()
+        self.lifetime = self.lifetime.copy()
+        del self.tile_flags
+        self.release()
+        self.workers = []
+        self.shared = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def generate_cave(self, fill_ratio=0.45, iterations=15, connect=None, min_size=1):
+        """Generate a cave using B678/S2345678 rule.
+
+        With connect set to "fill" or "tunnel" the cave is passed to connect_cave afterwards.
+        """
+        # Initialize grid with random cells and border walls
+        walls = self.rng.random((self.height, self.width)) < fill_ratio
+        walls[[0, -1], :] = True
+        walls[:, [0, -1]] = True
+
+        # Apply B678/S2345678 rule for specified iterations, border cells never change.
+        # Grids thinner than 3 cells are all border, so there is nothing to iterate
+        inner_cells = self.width > 2 and self.height > 2
+        for _ in range(iterations if inner_cells else 0):
+            neighbors = self._count_neighbors(walls)
+            inner = walls[1:-1, 1:-1]
+
+            # Birth: B678, survival: S2345678
+            born = ~inner & (neighbors >= 6)
+            survives = inner & (neighbors >= 2)
+            walls[1:-1, 1:-1] = born | survives
+
+        # Planes are overwritten in place, they may live in shared memory
+        self.elements[:] = np.where(walls, WALL, EMPTY)
+        self.water.fill(0)
+        self.lifetime.fill(0)
+        self.quiet.fill(0)
+        self.painted.fill(True)
+        if connect is not None:
+            return self.connect_cave(connect, min_size)
+
+        # A replay starts from the newest cave
+        if self.recording is not None:
+            self.start_recording()
+
+    def connect_cave(self, mode="fill", min_size=1):
+        """Keep the largest cavern and fill or tunnel to the pockets that are cut off from it.
+
+        Caverns are the 4-connected regions of cells that are not wall, so every element can
+        move through a cavern. With "fill" every pocket becomes wall. With "tunnel" pockets of
+        at least min_size cells are joined to the largest cavern by short tunnels, possibly through
+        other pockets, and smaller ones are filled. Returns statistics of the regions found and
+        what was done with them.
+        """
+        if mode not in ("fill", "tunnel"):
+            raise ValueError(f"Unknown connect mode: {mode}")
+        labels, sizes = label_regions(self.elements != WALL)
+        stats = {
+            "regions": len(sizes) - 1,
+            "sizes": sorted(sizes[1:].tolist(), reverse=True),
+            "largest": int(sizes.max()),
+            "filled": 0,
+            "filled_cells": 0,
+            "tunnels": 0,
+            "tunnel_cells": 0,
+        }
+        if len(sizes) <= 2:
+            return stats
+
+        largest = int(np.argmax(sizes))
+        pockets = np.arange(len(sizes)) != largest
+        pockets[0] = False
+        if mode == "tunnel":
+            tunneled = pockets & (sizes >= min_size)
+            pockets &= ~tunneled
+        fill = pockets[labels]
+        stats["filled"] = int(pockets.sum())
+        stats["filled_cells"] = int(sizes[pockets].sum())
+
+        # Planes are written in place, like generate_cave does, and the touched chunks are woken
+        self.elements[fill] = WALL
+        self.water[fill] = 0
+        self.lifetime[fill] = NO_LIFETIME
+        touched = fill
+        if mode == "tunnel" and tunneled.any():
+            # Tunnels may cross any cell but the border walls
+            passable = np.zeros(labels.shape, dtype=bool)
+            passable[1:-1, 1:-1] = True
+            tunneled[largest] = True
+            dug, stats["tunnels"] = dig_tunnels(np.where(tunneled[labels], labels, 0), passable)
+            self.elements[dug] = EMPTY
+            stats["tunnel_cells"] = int(dug.sum())
+            touched = touched | dug
+        self._wake_chunks(self._chunk_flags(touched))
+
+        # A replay starts from the newest cave
+        if self.recording is not None:
+            self.start_recording()
+        return stats
+
+    def get_state(self):
+        """Copy of everything a run needs to continue exactly, as arrays for np.savez"""
+        return {
+            "elements": self.elements.copy(),
+            "water": self.water.copy(),
+            "lifetime": self.lifetime.copy(),
+            "quiet": self.quiet.copy(),
+            "frame": np.array(self.frame),
+            "mode": np.array(self.mode),
+            "chunk_size": np.array(self.chunk_size),
+            "water_iterations": np.array(self.water_iterations),
+            "rng_state": np.array(json.dumps(self.rng.bit_generator.state)),
+        }
+
+    def set_state(self, state):
+        """Continue from a state made by get_state on an automaton of the same size, mode and water pass"""
+        if state["elements"].shape != self.elements.shape or str(state["mode"]) != self.mode:
+            raise ValueError("State belongs to an automaton of another size or mode")
+        # States saved before the water pass existed always used the per-cell water handler
+        if int(state.get("water_iterations", 0)) != self.water_iterations:
+            raise ValueError("State belongs to an automaton with another number of water iterations")
+        # Planes are overwritten in place, they may live in shared memory
+        self.elements[:] = state["elements"]
+        water = state["water"]
+        if water.dtype.kind == 'f':
+            water = np.rint(water * WATER_UNIT)  # states saved before the fixed point plane
+        self.water[:] = water
+        self.lifetime[:] = state["lifetime"]
+        self.quiet[:] = state["quiet"]
+        self.painted.fill(True)
+        self.frame = int(state["frame"])
+        self.rng.bit_generator.state = json.loads(str(state["rng_state"]))
+
+    def save_checkpoint(self, path, background=True):
+        """Write the state to a compressed .npz file.
+
+        The state is copied right away and written by a thread, so the run can go on meanwhile.
+        Returns the thread, join it to wait for the file.
+        """
+        state = self.get_state()
+        writer = threading.Thread(target=np.savez_compressed, args=(path,), kwargs=state)
+        writer.start()
+        if not background:
+            writer.join()
+        return writer
+
+    @classmethod
+    def load_checkpoint(cls, path, tiles=1):
+        """New automaton continuing from a checkpoint or the start of a replay file"""
+        with np.load(path) as data:
+            state = {key: data[key] for key in data.files}
+        height, width = state["elements"].shape
+        ca = cls(width, height, mode=str(state["mode"]), chunk_size=int(state["chunk_size"]), tiles=tiles,
+                 water_iterations=int(state.get("water_iterations", 0)))
+        ca.set_state(state)
+        return ca
+
+    def start_recording(self):
+        """Remember the current state and log every added element from here on"""
+        self.recording = self.get_state()
+        self.inputs = []
+
+    def save_replay(self, path):
+        """Write the recorded start state, the logged inputs and the current frame to a .npz file"""
+        if self.recording is None:
+            raise ValueError("Nothing recorded, call start_recording first")
+        # Single inputs are tuples and bulk insertions arrays of them
+        inputs = [np.array(entry, dtype=np.int64).reshape(-1, 4) for entry in self.inputs]
+        inputs = np.concatenate(inputs) if inputs else np.empty((0, 4), dtype=np.int64)
+        np.savez_compressed(path, inputs=inputs, end_frame=np.array(self.frame), **self.recording)
+
+    @property
+    def awake(self):
+        """Chunks that are updated in the next frame"""
+        return self.quiet < self.sleep_frames
+
+    @property
+    def dirty_rect(self):
+        """(rows, cols) slices around the chunks changed by the last frame or painted before it, or None"""
+        rows = np.flatnonzero(self.changed.any(axis=1))
+        cols = np.flatnonzero(self.changed.any(axis=0))
+        if len(rows) == 0:
+            return None
+        return self._chunk_slices(int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+
+    def _chunk_slices(self, top, bottom, left, right):
+        """Cell slices covering a range of chunks"""
+        size = self.chunk_size
+        return (slice(top * size, min(bottom * size, self.height)),
+                slice(left * size, min(right * size, self.width)))
+
+    def _active_rects(self):
+        """Rectangles of whole chunks that hold every awake chunk and its neighbours.
+
+        Particles move at most one cell per frame, so nothing outside them can change.
+        """
+        near = dilate_chunks(self.awake)
+        rects = []
+        for top, bottom in true_runs(near.any(axis=1)):
+            for left, right in true_runs(near[top:bottom].any(axis=0)):
+                rects.append(self._chunk_slices(top, bottom, left, right))
+        return rects
+
+    def _chunk_flags(self, mask):
+        """Reduce a cell mask over a chunk-aligned rectangle to one flag per chunk"""
+        size = self.chunk_size
+        # Along rows first, reducing the contiguous axis of the full mask is several times faster
+        mask = np.logical_or.reduceat(mask, np.arange(0, mask.shape[1], size), axis=1)
+        return np.logical_or.reduceat(mask, np.arange(0, mask.shape[0], size), axis=0)
+
+    def _chunk_cells(self, rows, cols, flags):
+        """Expand the chunk flags under a chunk-aligned rectangle to one flag per cell"""
+        size = self.chunk_size
+        flags = flags[rows.start // size:-(-rows.stop // size), cols.start // size:-(-cols.stop // size)]
+        cells = np.repeat(np.repeat(flags, size, axis=0), size, axis=1)
+        return cells[:rows.stop - rows.start, :cols.stop - cols.start]
+
+    def _mark_changes(self, changed, rows, cols, before, after):
+        """Flag the chunks of a rectangle where any plane differs between before and after"""
+        self._mark_cells(changed, rows, cols, changed_cells(before, after))
+
+    def _mark_cells(self, chunks, rows, cols, mask):
+        """Flag the chunks of a rectangle that hold a set cell of mask"""
+        size = self.chunk_size
+        flags = self._chunk_flags(mask)
+        chunks[rows.start // size:rows.start // size + flags.shape[0],
+               cols.start // size:cols.start // size + flags.shape[1]] |= flags
+
+    def _wake(self, x, y):
+        """Wake the chunk of a cell and its neighbours, and mark the chunk for redrawing"""
+        chunk_y, chunk_x = y // self.chunk_size, x // self.chunk_size
+        self.quiet[max(chunk_y - 1, 0):chunk_y + 2, max(chunk_x - 1, 0):chunk_x + 2] = 0
+        self.painted[chunk_y, chunk_x] = True
+
+    def _wake_chunks(self, flags):
+        """Wake the flagged chunks and their neighbours, and mark the flagged chunks for redrawing"""
+        self.quiet[dilate_chunks(flags)] = 0
+        self.painted |= flags
+
+    def _count_neighbors(self, mask):
+        """Count set neighbors of every inner cell by summing the 8 shifted views of mask"""
+        cells = mask.view(np.uint8)
+        inner_height, inner_width = self.height - 2, self.width - 2
+        count = np.zeros((inner_height, inner_width), dtype=np.uint8)
+        for dy in range(3):
+            for dx in range(3):
+                if dx == 1 and dy == 1:
+                    continue
+                count += cells[dy:dy + inner_height, dx:dx + inner_width]
+        return count
 
-        # Fire tries to move randomly downward when possible
-        directions = [(0, 1), (-1, 1), (1, 1)]  # Down, Down-left, Down-right
-        random.shuffle(directions)
+    def enable_stats(self, window=60):
+        """Start recording per-frame counts and times of the parts of update, returns the stats"""
+        self.stats = UpdateStats(window)
+        return self.stats
 
-        moved = False
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            if self._is_empty(nx, ny):
-                self.next_grid[y, x] = EMPTY
-                self.next_grid[ny, nx] = FIRE
-                moved = True
-                break
+    def disable_stats(self):
+        self.stats = None
 
-        # Fire did not move
-        if not moved:
-            # Check if wood below
-            if 0 <= y + 1 < self.height and int(self.grid[y + 1, x]) == WOOD:
-                self.next_grid[y + 1, x] = FIRE
-                self.next_grid[y, x] = DARK_SMOKE
-            else:
-                self.next_grid[y, x] = LIGHT_SMOKE
-
-    def _update_smoke(self, x, y, smoke_type):
-        """Update smoke behavior"""
-        # Move upward
-        directions = [(0, -1), (-1, -1), (1, -1)]  # Up, Up-left, Up-right
-        random.shuffle(directions)
-        nx, ny = 0, 0
-        moved = False
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-            if self._is_empty(nx, ny):
-                self.next_grid[y, x] = EMPTY
-                self.next_grid[ny, nx] = smoke_type
-
-                # Transfer the lifetime to the new position
-                if (x, y) in self.smoke_lifetimes:
-                    self.smoke_lifetimes[(nx, ny)] = self.smoke_lifetimes[(x, y)]
-                    del self.smoke_lifetimes[(x, y)]
-                else:
-                    # Create new lifetime
-                    if smoke_type == DARK_SMOKE:
-                        self.smoke_lifetimes[(nx, ny)] = random.randint(10, 20)
-                    else:
-                        self.smoke_lifetimes[(nx, ny)] = random.randint(7, 10)
-
-                moved = True
-                break
+    def _phase(self, name):
+        """Context that times a part of the frame, it does nothing while stats are disabled"""
+        if self.stats is None:
+            return nullcontext()
+        return self.stats.timer(name)
 
-        # Move sideways
-        if not moved:
-            sideways = [(-1, 0), (1, 0)]  # Left, Right
-            random.shuffle(sideways)
+    def update(self):
+        """Update the grid for one generation"""
+        start = time.perf_counter()
+        drifting = None
+        if self.workers:
+            with self._phase("tiles"):
+                changed, drifting = self._update_tiled()
+        elif self.mode == "margolus":
+            changed, drifting = self._update_margolus()
+        else:
+            changed = self._update_serial()
+
+        # Chunks next to a change stay awake, the others count another quiet frame
+        with self._phase("chunks"):
+            near = dilate_chunks(changed)
+            if drifting is not None:
+                near |= drifting  # smoke that may still drift keeps its chunk awake
+            self.quiet = np.where(near, 0, np.minimum(self.quiet, self.sleep_frames) + 1).astype(np.uint8)
+            self.changed = changed | self.painted
+            self.painted.fill(False)
+        self.frame += 1
+
+        if self.stats is not None:
+            self.stats.add("frame", time.perf_counter() - start)
+            self.stats.end_frame()
+
+    def _update_serial(self):
+        """Update every particle one by one, reading the current grid and writing the next one"""
+        rects = self._active_rects()
+        awake = self.awake
+        active_y = [np.empty(0, dtype=np.intp)]
+        active_x = [np.empty(0, dtype=np.intp)]
+        for rows, cols in rects:
+            # The next planes only need to match the current ones where particles can move
+            with self._phase("copies"):
+                self.next_elements[rows, cols] = self.elements[rows, cols]
+                self.next_water[rows, cols] = self.water[rows, cols]
+                self.next_lifetime[rows, cols] = self.lifetime[rows, cols]
+                self.processed[rows, cols] = False
+
+            # Only cells in awake chunks that are not empty or walls are scheduled
+            with self._phase("schedule"):
+                cells = self.elements[rows, cols]
+                scheduled = self._chunk_cells(rows, cols, awake) & (cells != EMPTY) & (cells != WALL)
+                if self.water_iterations:
+                    scheduled &= cells != WATER  # moved by the water pass instead
+                ys, xs = np.nonzero(scheduled)
+                active_y.append(ys + rows.start)
+                active_x.append(xs + cols.start)
+
+        with self._phase("shuffle"):
+            active_y = np.concatenate(active_y)
+            active_x = np.concatenate(active_x)
+
+            # Visit them in random order to avoid directional bias
+            order = self.rng.permutation(len(active_x))
+            active_y, active_x = active_y[order], active_x[order]
+            # Plain Python ints make the type tests below cheap compares
+            types = self.elements[active_y, active_x].tolist()
+            # Handlers take their randomness from this buffer, so a seed makes the whole run reproducible
+            self.rolls = iter(self.rng.integers(0, ROLL_RANGE, size=len(types)).tolist())
+
+        if self.stats is None:
+            for x, y, cell_type in zip(active_x.tolist(), active_y.tolist(), types):
+                # Skip cells that were displaced by an earlier particle this frame
+                if self.processed[y, x]:
+                    continue
 
-            for dx, dy in sideways:
+                kernel = self.kernels[cell_type]
+                if kernel is not None:
+                    kernel(x, y)
+        else:
+            # The timed loop is separate, so the plain one pays nothing for instrumentation
+            self._update_particles_timed(active_x.tolist(), active_y.tolist(), types)
+
+        changed = np.zeros_like(self.quiet, dtype=bool)
+        for rows, cols in rects:
+            after = (self.next_elements[rows, cols], self.next_water[rows, cols], self.next_lifetime[rows, cols])
+            if self.water_iterations:
+                with self._phase("water pass"):
+                    water_pass(after[0], after[1], self.water_iterations)
+            with self._phase("lifetimes"):
+                self._update_lifetimes(after[0], after[2])
+            before = (self.elements[rows, cols], self.water[rows, cols], self.lifetime[rows, cols])
+            with self._phase("changes"):
+                self._mark_changes(changed, rows, cols, before, after)
+
+            with self._phase("copies"):
+                self.elements[rows, cols] = after[0]
+                self.water[rows, cols] = after[1]
+                self.lifetime[rows, cols] = after[2]
+        return changed
+
+    def _update_particles_timed(self, active_x, active_y, types):
+        """The particle loop of the serial update, counting and timing every handler call"""
+        counts = dict.fromkeys(ELEMENTS, 0)
+        seconds = dict.fromkeys(ELEMENTS, 0.0)
+        clock = time.perf_counter
+        for x, y, cell_type in zip(active_x, active_y, types):
+            if self.processed[y, x]:
+                continue
+            start = clock()
+            self._update_particle(x, y, cell_type)
+            seconds[cell_type] += clock() - start
+            counts[cell_type] += 1
+
+        for cell_type, count in counts.items():
+            if count:
+                self.stats.add(ELEMENTS[cell_type].name.lower(), seconds[cell_type], count)
+
+    def _update_particle(self, x, y, cell_type):
+        """Update one particle, the plain loop in _update_serial does this inline"""
+        kernel = self.kernels[cell_type]
+        if kernel is not None:
+            kernel(x, y)
+
+    def _update_element(self, cell_type, reactions, groups, blocked, ages, x, y):
+        """Update one particle from the lookup tables of its element, bound to them in self.kernels"""
+        # Reactions look at the neighbours as they were at the start of the frame
+        for dx, dy, table in reactions:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < self.width and 0 <= ny < self.height:
+                result = table.get(self.elements[ny, nx])
+                if result is not None:
+                    self.next_elements[y, x], self.next_elements[ny, nx] = result
+                    return
+
+        # One roll picks the order of every move group
+        roll = next(self.rolls)
+        for orders, actions in groups:
+            order = orders[roll % len(orders)]
+            roll //= len(orders)
+            for dx, dy in order:
                 nx, ny = x + dx, y + dy
-                if self._is_empty(nx, ny):
-                    self.next_grid[y, x] = EMPTY
-                    self.next_grid[ny, nx] = smoke_type
-
-                    moved = True
-                    break
-
-        if moved:
-            # Transfer the lifetime
-            if (x, y) in self.smoke_lifetimes:
-                self.smoke_lifetimes[(nx, ny)] = self.smoke_lifetimes[(x, y)]
-                del self.smoke_lifetimes[(x, y)]
-            else:
-                # Create new lifetime
-                if smoke_type == DARK_SMOKE:
-                    self.smoke_lifetimes[(nx, ny)] = random.randint(10, 20)
-                else:
-                    self.smoke_lifetimes[(nx, ny)] = random.randint(7, 10)
+                if 0 <= nx < self.width and 0 <= ny < self.height:
+                    if actions[self.next_elements[ny, nx]] == MOVE:
+                        self._move(x, y, nx, ny, cell_type, MOVE, ages)
+                        return
+                    # Displaced elements are looked up where they were at the start of the frame
+                    if actions[self.elements[ny, nx]] == SWAP:
+                        self._move(x, y, nx, ny, cell_type, SWAP, ages)
+                        return
+
+        if blocked is not None:
+            self.next_elements[y, x] = blocked
+
+    def _move(self, x, y, nx, ny, cell_type, action, ages):
+        """Move a particle with its water and lifetime, into an empty cell or swapping with the target.
+
+        A swapped target is taken as it was at the start of the frame.
+        """
+        water = self.next_water[y, x]
+        lifetime = self.next_lifetime[y, x]
+        if ages and (ny < y or lifetime == NO_LIFETIME):
+            # Rising gives a new lifetime, so it only runs out once the particle stops rising
+            lifetime = NEW_LIFETIME
+
+        if action == SWAP:
+            self.next_elements[y, x] = self.elements[ny, nx]
+            self.next_water[y, x] = self.water[ny, nx]
+            self.next_lifetime[y, x] = self.lifetime[ny, nx]
+            self.processed[ny, nx] = True
+        else:
+            # Empty cells have no water or lifetime, so those planes only change when the particle has them
+            self.next_elements[y, x] = EMPTY
+            if water:
+                self.next_water[y, x] = 0
+            if lifetime:
+                self.next_lifetime[y, x] = NO_LIFETIME
+        self.next_elements[ny, nx] = cell_type
+        if water or action == SWAP:
+            self.next_water[ny, nx] = water
+        if lifetime or action == SWAP:
+            self.next_lifetime[ny, nx] = lifetime
+
+    def _update_margolus(self):
+        """Update the grid with the 2x2 block rules, the block offset alternates every frame.
+
+        Returns the chunk flags of changes and of smoke that may still drift.
+        """
+        offset = self.frame % 2
+        changed = np.zeros_like(self.quiet, dtype=bool)
+        drifting = np.zeros_like(changed)
+        for rows, cols in self._active_rects():
+            after = (self.elements[rows, cols], self.water[rows, cols], self.lifetime[rows, cols])
+            with self._phase("copies"):
+                before = tuple(plane.copy() for plane in after)
+
+            # Rectangles start on even cells, so their blocks line up with the blocks of the whole grid
+            with self._phase("blocks"):
+                height, width = after[0].shape
+                bits = self.rng.integers(0, 256, size=(max((height - offset) // 2, 0), max((width - offset) // 2, 0)),
+                                         dtype=np.uint8)
+                halo = None
+                if rows.stop < self.height:
+                    halo = (self.elements[rows.stop, cols], self.water[rows.stop, cols])
+                margolus_step(*after, offset, bits, halo)
+
+            with self._phase("lifetimes"):
+                self._update_lifetimes(after[0], after[2])
+            with self._phase("changes"):
+                self._mark_changes(changed, rows, cols, before, after)
+                self._mark_cells(drifting, rows, cols, drifting_cells(after[0]))
+        return changed, drifting
+
+    def _update_tiled(self):
+        """Let every tile worker step its whole tile once, sleeping chunks are not skipped here.
+
+        Returns the same chunk flags as _update_margolus.
+        """
+        self.tile_flags.fill(False)
+        self.tile_frame.value = self.frame
+        # Each frame's tile seed comes from the automaton's generator, so a seed reproduces tiled runs too
+        self.tile_seed.value = int(self.rng.integers(2 ** 63))
+        try:
+            self.tile_start.wait(TILE_TIMEOUT)
+            self.tile_done.wait(TILE_TIMEOUT)
+        except BrokenBarrierError:
+            # The planes keep the state of the failed frame, half stepped at worst
+            self._release_tiles()
+            raise RuntimeError("A tile worker failed or stopped answering, the tiles were shut down") from None
+        return self.tile_flags[0].copy(), self.tile_flags[1].copy()
+
+    def _update_lifetimes(self, elements, lifetime):
+        """Age the smoke in the given planes with the automaton's generator"""
+        age_smoke(elements, lifetime, self.rng, self.lifetime_low, self.lifetime_high)
+
+    def _is_empty(self, x, y):
+        """Check if a cell is empty and within bounds"""
+        return (0 <= x < self.width and 0 <= y < self.height and
+                self.next_elements[y, x] == EMPTY)
+
+    def _is_within_bounds(self, x, y):
+        """Check if coordinates are within grid bounds"""
+        return 0 <= x < self.width and 0 <= y < self.height
 
     def _update_water(self, x, y):
         """Update water behavior with complete conservation of mass"""
-        water_amount = self.grid[y, x]
-        MIN_WATER = 8.0
-        MAX_WATER = 15.0
+        water_amount = int(self.water[y, x])  # plain ints, sums of plane values overflow uint16
 
         # DOWNWARD FLOW
         if self._is_empty(x, y + 1):
-            self.next_grid[y, x] = EMPTY
-            self.next_grid[y + 1, x] = water_amount
+            self.next_elements[y, x] = EMPTY
+            self.next_water[y, x] = 0
+            self.next_elements[y + 1, x] = WATER
+            self.next_water[y + 1, x] = water_amount
             return
 
         # PRESSURE EQUALIZATION WITH WATER BELOW
-        if y + 1 < self.height and MIN_WATER <= self.next_grid[y + 1, x] < MAX_WATER:
+        if (y + 1 < self.height and self.next_elements[y + 1, x] == WATER and
+                self.next_water[y + 1, x] < MAX_WATER):
             # Water below, add this water to it
-            below_amount = self.next_grid[y + 1, x]
+            below_amount = int(self.next_water[y + 1, x])
             excess = water_amount - MIN_WATER
             if (below_amount + excess) > MAX_WATER:
                 # Can't fit all excess below, keep some here
                 transfer = MAX_WATER - below_amount
-                self.next_grid[y, x] = water_amount - transfer
-                self.next_grid[y + 1, x] = MAX_WATER
+                self.next_water[y, x] = water_amount - transfer
+                self.next_water[y + 1, x] = MAX_WATER
             else:
                 # Transfer all excess
-                self.next_grid[y, x] = EMPTY
-                self.next_grid[y + 1, x] = below_amount + (water_amount - MIN_WATER)
+                self.next_elements[y, x] = EMPTY
+                self.next_water[y, x] = 0
+                self.next_water[y + 1, x] = below_amount + (water_amount - MIN_WATER)
             return
 
         # HORIZONTAL FLOW
@@ -312,17 +1452,23 @@ class CellularAutomaton2D:
 
         if left_empty or right_empty:
             excess = water_amount - MIN_WATER
-            if excess > 0.5:
+            if excess > WATER_UNIT // 2:
+                # Leftover units of the split stay in this cell
                 if left_empty and right_empty:
-                    self.next_grid[y, x] = MIN_WATER + excess / 3
-                    self.next_grid[y, x - 1] = MIN_WATER + excess / 3
-                    self.next_grid[y, x + 1] = MIN_WATER + excess / 3
+                    share = excess // 3
+                    self.next_water[y, x] = water_amount - 2 * share
+                    self.next_elements[y, x - 1] = WATER
+                    self.next_water[y, x - 1] = MIN_WATER + share
+                    self.next_elements[y, x + 1] = WATER
+                    self.next_water[y, x + 1] = MIN_WATER + share
                 elif left_empty:
-                    self.next_grid[y, x] = MIN_WATER + excess / 2
-                    self.next_grid[y, x - 1] = MIN_WATER + excess / 2
+                    self.next_water[y, x] = water_amount - excess // 2
+                    self.next_elements[y, x - 1] = WATER
+                    self.next_water[y, x - 1] = MIN_WATER + excess // 2
                 elif right_empty:
-                    self.next_grid[y, x] = MIN_WATER + excess / 2
-                    self.next_grid[y, x + 1] = MIN_WATER + excess / 2
+                    self.next_water[y, x] = water_amount - excess // 2
+                    self.next_elements[y, x + 1] = WATER
+                    self.next_water[y, x + 1] = MIN_WATER + excess // 2
                 return
 
         # EQUALIZE WITH EXISTING WATER AT SIDES
@@ -334,77 +1480,247 @@ class CellularAutomaton2D:
             nx = x + dx
             if not self._is_within_bounds(nx, y):
                 continue
-            if self.next_grid[y, nx] >= MIN_WATER:
-                side_amount = self.next_grid[y, nx]
+            if self.next_elements[y, nx] == WATER:
+                side_amount = int(self.next_water[y, nx])
                 side_cells.append((nx, side_amount))
                 total_water += side_amount
                 cells_count += 1
 
         if side_cells:
-            # Calculate equilibrium level
-            equilibrium = total_water / cells_count
-            self.next_grid[y, x] = equilibrium
+            # Calculate equilibrium level, leftover units stay in this cell
+            equilibrium = total_water // cells_count
+            self.next_water[y, x] = total_water - equilibrium * len(side_cells)
 
             for nx, side_amount in side_cells:
-                self.next_grid[y, nx] = equilibrium
+                self.next_water[y, nx] = equilibrium
 
             return
 
-        self.next_grid[y, x] = water_amount
-
-    def _update_balloon(self, x, y):
-        """Update balloon behavior"""
-        directions = [(0, -1), (-1, -1), (1, -1)]  # Up, Up-left, Up-right
-        random.shuffle(directions)
-        dx, dy = directions[0]
-        nx, ny = x + dx, y + dy
-        if self._is_empty(nx, ny):
-            self.next_grid[y, x] = EMPTY
-            self.next_grid[ny, nx] = BALLOON
-        else:
-            self.next_grid[y, x] = EMPTY
+        self.next_water[y, x] = water_amount
 
     def add_element(self, x, y, element_type):
         """Add an element at the specified position"""
+        if self.recording is not None:
+            self.inputs.append((self.frame, x, y, element_type))
         if 0 <= x < self.width and 0 <= y < self.height:
-            if not self._is_empty(x, y) and element_type != EMPTY:
+            if self.elements[y, x] != EMPTY and element_type != EMPTY:
                 return
 
-            # self.grid[y, x] = element_type
-            if element_type == WATER:
-                # Random water amount between 8 and 15
-                self.grid[y, x] = 15
-            else:
-                self.grid[y, x] = element_type
+            element = ELEMENTS[element_type]
+            self.elements[y, x] = element_type
+            # New water always starts full, every other element has no water mass
+            self.water[y, x] = element.mass
+
+            # Smoke gets its lifetime drawn with the rest at the end of the next frame
+            self.lifetime[y, x] = NEW_LIFETIME if element.lifetime is not None else NO_LIFETIME
+            self._wake(x, y)
+
+    def add_elements(self, xs, ys, element_type):
+        """Add an element at many positions at once, with the same rules as add_element.
+
+        Positions outside the grid are skipped and, unless erasing, only empty cells are filled.
+        """
+        xs = np.asarray(xs, dtype=np.intp).ravel()
+        ys = np.asarray(ys, dtype=np.intp).ravel()
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        xs, ys = xs[inside], ys[inside]
+        if self.recording is not None:
+            self._record(xs, ys, element_type)
+        if element_type != EMPTY:
+            empty = self.elements[ys, xs] == EMPTY
+            xs, ys = xs[empty], ys[empty]
+        if len(xs) == 0:
+            return
 
-            # Initialize smoke lifetime if needed
-            if element_type in [DARK_SMOKE, LIGHT_SMOKE]:
-                # Create new lifetime
-                if element_type == DARK_SMOKE:
-                    self.smoke_lifetimes[(x, y)] = random.randint(10, 20)
-                elif element_type == LIGHT_SMOKE:
-                    self.smoke_lifetimes[(x, y)] = random.randint(7, 10)
+        element = ELEMENTS[element_type]
+        self.elements[ys, xs] = element_type
+        self.water[ys, xs] = element.mass
+        # New smoke gets its lifetimes drawn together at the end of the next frame
+        self.lifetime[ys, xs] = NEW_LIFETIME if element.lifetime is not None else NO_LIFETIME
+
+        flags = np.zeros_like(self.painted)
+        flags[ys // self.chunk_size, xs // self.chunk_size] = True
+        self._wake_chunks(flags)
+
+    def paint_mask(self, mask, element_type, x=0, y=0):
+        """Add an element wherever a boolean mask is set, with the mask's top left corner at (x, y).
+
+        Parts of the mask outside the grid are skipped. The planes are written through slices,
+        so filling large regions costs a few array operations.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        top, left = max(y, 0), max(x, 0)
+        bottom, right = min(y + mask.shape[0], self.height), min(x + mask.shape[1], self.width)
+        if top >= bottom or left >= right:
+            return
+        rows, cols = slice(top, bottom), slice(left, right)
+        mask = mask[top - y:bottom - y, left - x:right - x]
+        if self.recording is not None:
+            ys, xs = np.nonzero(mask)
+            self._record(xs + left, ys + top, element_type)
+        if element_type != EMPTY:
+            mask = mask & (self.elements[rows, cols] == EMPTY)
+
+        element = ELEMENTS[element_type]
+        np.copyto(self.elements[rows, cols], element_type, where=mask)
+        np.copyto(self.water[rows, cols], element.mass, where=mask)
+        np.copyto(self.lifetime[rows, cols], NEW_LIFETIME if element.lifetime is not None else NO_LIFETIME,
+                  where=mask)
+
+        # Pad the mask out to whole chunks, so it reduces to chunk flags like a chunk-aligned rectangle
+        size = self.chunk_size
+        chunk_top, chunk_left = top // size, left // size
+        padded = np.zeros((bottom - chunk_top * size, right - chunk_left * size), dtype=bool)
+        padded[top - chunk_top * size:, left - chunk_left * size:] = mask
+        written = self._chunk_flags(padded)
+        flags = np.zeros_like(self.painted)
+        flags[chunk_top:chunk_top + written.shape[0], chunk_left:chunk_left + written.shape[1]] = written
+        self._wake_chunks(flags)
+
+    def paint_rect(self, left, top, right, bottom, element_type):
+        """Fill the cells from (left, top) up to but not including (right, bottom), like slices"""
+        self.paint_mask(np.ones((max(bottom - top, 0), max(right - left, 0)), dtype=bool), element_type, left, top)
+
+    def paint_circle(self, x, y, radius, element_type):
+        """Stamp a round brush of the given radius centred on (x, y)"""
+        self.paint_mask(brush(radius), element_type, x - radius, y - radius)
+
+    def paint_line(self, x0, y0, x1, y1, element_type, radius=0):
+        """Draw a stroke from (x0, y0) to (x1, y1) with a round brush, without gaps between the ends"""
+        steps = max(abs(x1 - x0), abs(y1 - y0))
+        t = np.linspace(0, 1, steps + 1)
+        xs = np.rint(x0 + t * (x1 - x0)).astype(np.intp)
+        ys = np.rint(y0 + t * (y1 - y0)).astype(np.intp)
+
+        # Every point of the line gets the whole brush, cells covered twice are only added once
+        brush_ys, brush_xs = np.nonzero(brush(radius))
+        xs = (xs[:, None] + brush_xs - radius).ravel()
+        ys = (ys[:, None] + brush_ys - radius).ravel()
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        cells = np.unique(ys[inside] * self.width + xs[inside])
+        self.add_elements(cells % self.width, cells // self.width, element_type)
+
+    def _record(self, xs, ys, element_type):
+        """Log a bulk insertion for the replay, one input per cell"""
+        rows = np.empty((len(xs), 4), dtype=np.int64)
+        rows[:, 0] = self.frame
+        rows[:, 1] = xs
+        rows[:, 2] = ys
+        rows[:, 3] = element_type
+        self.inputs.append(rows)
+
+
+class SimulationThread:
+    """Runs an automaton on its own thread at a fixed tick rate and publishes rendered frames.
+
+    Frames go through a double buffer: a tick renders into the back buffer and swaps it with
+    the front one, so readers always get the newest finished frame and stale ones are dropped.
+    Calls that change the automaton are queued with submit and run before the next tick.
+    """
+
+    def __init__(self, ca, tick_rate=10):
+        self.ca = ca
+        self.period = 1 / tick_rate
+        self.renderer = FrameRenderer(ca.width, ca.height)
+        self.front = self.renderer.render(ca.elements, ca.water).copy()
+        self.back = self.front.copy()
+        self.version = 0  # number of frames published so far
+        self.lock = threading.Lock()
+        self.inputs = queue.SimpleQueue()
+        self.stopped = threading.Event()
+        self.error = None  # exception that ended the thread, if any
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop after the current tick and wait for the thread"""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def submit(self, function, *args):
+        """Queue a call on the simulation thread, it runs before the next tick"""
+        self.inputs.put((function, args))
+
+    def copy_latest(self, out, seen):
+        """Copy the newest frame into out unless its version is seen, return the newest version"""
+        with self.lock:
+            if self.version != seen:
+                np.copyto(out, self.front)
+            return self.version
+
+    def check(self):
+        """Re-raise the exception that ended the simulation thread, on the calling thread"""
+        if self.error is not None:
+            raise RuntimeError("The simulation thread failed") from self.error
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                start = time.perf_counter()
+                self._tick()
+                # Sleep the rest of the period, a slow tick starts the next one right away
+                self.stopped.wait(max(0.0, self.period - (time.perf_counter() - start)))
+        except Exception as error:
+            # A daemon thread would end silently, so the error is kept for check()
+            self.error = error
+            self.stopped.set()
+
+    def _tick(self):
+        while True:
+            try:
+                function, args = self.inputs.get_nowait()
+            except queue.Empty:
+                break
+            function(*args)
+
+        self.ca.update()
+        # Only chunks that changed are redrawn, a frame without changes is not published
+        region = self.ca.dirty_rect
+        if region is None:
+            return
+        self.renderer.render(self.ca.elements, self.ca.water, region)
+        np.copyto(self.back, self.renderer.rgb)
+        with self.lock:
+            self.front, self.back = self.back, self.front
+            self.version += 1
 
 
-def run_simulation(width, height):
+def run_simulation(width, height, mode="serial", show_stats=False):
     """Run the cellular automaton simulation"""
-    ca = CellularAutomaton2D(width, height)
+    # The Tk backend is only picked here, so the module can be imported without a display
+    matplotlib.use('TkAgg')  # better interactivity
+    ca = CellularAutomaton2D(width, height, mode=mode)
     ca.generate_cave()
+    ca.start_recording()
+    # The automaton is only touched by the simulation thread, the UI queues its changes there
+    sim = SimulationThread(ca)
 
     # Create figure and axis for animation
     fig, ax = plt.subplots(figsize=(10, 8))
-    img = ax.imshow(np.zeros((height, width, 3)), origin='upper')
+    display = sim.front.copy()
+    img = ax.imshow(display, origin='upper')
 
-    # Button axes
+    # Optional overlay with the per-frame counts and times of the update
+    stats_text = None
+    if show_stats:
+        ca.enable_stats()
+        stats_text = ax.text(0.01, 0.99, "", transform=ax.transAxes, va='top', family='monospace',
+                             fontsize=8, color='white', bbox=dict(facecolor='black', alpha=0.5))
+
+    # A button for every registered element that has one, and Clear
     button_axes = {}
-    elements = ["Sand", "Water", "Wood", "Fire", "Balloon", "Wall", "Empty", "Clear"]
+    elements = [element for element in ELEMENTS.values() if element.button]
+    names = [element.name for element in elements] + ["Clear"]
     button_height = 0.05
-    button_width = 0.09
     spacing = 0.015
+    button_width = min(0.09, 0.84 / len(names) - spacing)
 
-    for i, element in enumerate(elements):
+    for i, name in enumerate(names):
         pos = [0.1 + i * (button_width + spacing), 0.01, button_width, button_height]
-        button_axes[element] = plt.axes(pos)
+        button_axes[name] = plt.axes(pos)
 
     # Create buttons
     buttons = {}
@@ -416,83 +1732,91 @@ def run_simulation(width, height):
 
         return callback
 
-    buttons["Sand"] = Button(button_axes["Sand"], "Sand")
-    buttons["Sand"].on_clicked(create_button_callback(SAND))
-
-    buttons["Water"] = Button(button_axes["Water"], "Water")
-    buttons["Water"].on_clicked(create_button_callback(WATER))
-
-    buttons["Wood"] = Button(button_axes["Wood"], "Wood")
-    buttons["Wood"].on_clicked(create_button_callback(WOOD))
-
-    buttons["Fire"] = Button(button_axes["Fire"], "Fire")
-    buttons["Fire"].on_clicked(create_button_callback(FIRE))
-
-    buttons["Balloon"] = Button(button_axes["Balloon"], "Balloon")
-    buttons["Balloon"].on_clicked(create_button_callback(BALLOON))
-
-    buttons["Wall"] = Button(button_axes["Wall"], "Wall")
-    buttons["Wall"].on_clicked(create_button_callback(WALL))
-
-    buttons["Empty"] = Button(button_axes["Empty"], "Empty")
-    buttons["Empty"].on_clicked(create_button_callback(EMPTY))
+    for element in elements:
+        buttons[element.name] = Button(button_axes[element.name], element.name)
+        buttons[element.name].on_clicked(create_button_callback(element.code))
 
     def clear_callback(event):
-        ca.grid = ca.grid * 0
-        ca.next_grid = ca.next_grid * 0
-        ca.smoke_lifetimes = {}
-        ca.generate_cave()
+        sim.submit(ca.generate_cave)
 
     buttons["Clear"] = Button(button_axes["Clear"], "Clear")
     buttons["Clear"].on_clicked(clear_callback)
 
-    # Mouse interaction
+    # Mouse interaction, a stroke connects the last two mouse positions so fast moves leave no gaps
     drawing = [False]
+    last = [None]
+    brush_radius = [1]
 
     def on_press(event):
         if event.inaxes == ax:
             drawing[0] = True
-            # x, y = int(event.xdata), int(event.ydata)
             x, y = int(round(event.xdata)), int(round(event.ydata))
-            ca.add_element(x, y, selected_element[0])
+            last[0] = (x, y)
+            sim.submit(ca.paint_circle, x, y, brush_radius[0], selected_element[0])
 
     def on_release(event):
         drawing[0] = False
 
     def on_motion(event):
         if drawing[0] and event.inaxes == ax:
-            x, y = int(event.xdata), int(event.ydata)
-            ca.add_element(x, y, selected_element[0])
+            x, y = int(round(event.xdata)), int(round(event.ydata))
+            sim.submit(ca.paint_line, *last[0], x, y, selected_element[0], brush_radius[0])
+            last[0] = (x, y)
 
     fig.canvas.mpl_connect('button_press_event', on_press)
     fig.canvas.mpl_connect('button_release_event', on_release)
     fig.canvas.mpl_connect('motion_notify_event', on_motion)
 
-    # Update function for the timer
+    # Keys not taken by matplotlib: w writes a checkpoint, e the replay since the last cave,
+    # [ and ] make the brush smaller and larger
+    def save_checkpoint():
+        ca.save_checkpoint("checkpoint.npz")
+        print(f"Checkpoint of frame {ca.frame} saved to checkpoint.npz")
+
+    def save_replay():
+        ca.save_replay("replay.npz")
+        print(f"Replay of frames up to {ca.frame} saved to replay.npz")
+
+    def on_key(event):
+        if event.key == 'w':
+            sim.submit(save_checkpoint)
+        elif event.key == 'e':
+            sim.submit(save_replay)
+        elif event.key == '[':
+            brush_radius[0] = max(brush_radius[0] - 1, 0)
+        elif event.key == ']':
+            brush_radius[0] += 1
+
+    fig.canvas.mpl_connect('key_press_event', on_key)
+    fig.canvas.mpl_connect('close_event', lambda event: sim.stop())
+
+    # The timer only shows the newest finished frame, frames made in between are skipped
+    shown = [0]
+
     def update_frame():
-        ca.update()
-        # Convert grid to RGB
-        rgb_grid = np.zeros((height, width, 3))
-        for y in range(height):
-            for x in range(width):
-                cell_type = int(ca.grid[y, x])
-                if WATER <= cell_type <= 15:
-                    # Use dynamic water color based on value
-                    rgb_grid[y, x] = get_water_color(ca.grid[y, x])
-                elif cell_type in COLORS:
-                    rgb_grid[y, x] = COLORS[cell_type]
-        img.set_array(rgb_grid)
-        fig.canvas.draw_idle()
+        if sim.error is not None:
+            # Stop polling a dead thread and report its error once
+            timer.stop()
+            sim.check()
+        version = sim.copy_latest(display, shown[0])
+        if version != shown[0]:
+            shown[0] = version
+            img.set_data(display)
+            if stats_text is not None:
+                stats_text.set_text(ca.stats.format())
+            fig.canvas.draw_idle()
         return True  # Keep the timer running
 
-    # Create a timer for regular updates
-    # timer = fig.canvas.new_timer(interval=500)
-    timer = fig.canvas.new_timer(interval=100)
+    # Create a timer for regular updates, faster than the simulation ticks
+    timer = fig.canvas.new_timer(interval=30)
     timer.add_callback(update_frame)
     timer.start()
+    sim.start()
 
     # Show the figure (will block until closed)
     plt.show()
+    sim.stop()
+    sim.check()
 
 
 def CellularAutomaton_2D():
@@ -0,0 +1,135 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+from Automaton_2D import CellularAutomaton2D, UPDATE_MODES, EMPTY, WALL, SAND, WOOD, FIRE, WATER
+
+
+def parse_size(text):
+    """Parse a WIDTHxHEIGHT size like 512x256"""
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def build_scenario(width, height, seed=0, mode="serial", tiles=1, connect=None):
+    """Seeded benchmark world: a cave with a sand pile, a water pool and a burning wood block.
+
+    connect is passed to generate_cave, "fill" or "tunnel" leave a cave without closed pockets.
+    """
+    ca = CellularAutomaton2D(width, height, seed=seed, mode=mode, tiles=tiles)
+    ca.generate_cave(connect=connect)
+
+    def fill(left, top, right, bottom, element_type):
+        # Regions are fractions of the world, so every size gets the same picture
+        ca.paint_rect(max(int(left * width), 1), max(int(top * height), 1),
+                      min(int(right * width), width - 1), min(int(bottom * height), height - 1), element_type)
+
+    fill(0.15, 0.1, 0.35, 0.3, SAND)
+    fill(0.6, 0.1, 0.85, 0.3, WATER)
+    fill(0.4, 0.5, 0.55, 0.6, WOOD)
+    fill(0.4, 0.48, 0.55, 0.5, FIRE)
+    return ca
+
+
+def count_particles(ca):
+    """Number of cells that are neither empty nor wall"""
+    return int(np.count_nonzero((ca.elements != EMPTY) & (ca.elements != WALL)))
+
+
+def run_benchmark(width, height, steps=100, seed=0, mode="serial", memory_steps=5, tiles=1, stats=False,
+                  connect=None):
+    """Time steps of update() on the benchmark scenario and measure its peak memory.
+
+    With stats the per-part counts and times of update are added, at some cost to the timing.
+    """
+    ca = build_scenario(width, height, seed, mode, tiles, connect)
+    if stats:
+        ca.enable_stats(window=steps)
+
+    # Only update() is timed, particles are counted between the steps
+    elapsed = 0.0
+    particles = 0
+    for _ in range(steps):
+        particles += count_particles(ca)
+        start = time.perf_counter()
+        ca.update()
+        elapsed += time.perf_counter() - start
+    ca.close()
+    phases = ca.stats.summary() if stats else None
+
+    # Memory is traced in a separate short run, tracing slows the timed one down.
+    # Only the main process is traced, tile workers are not counted
+    tracemalloc.start()
+    ca = build_scenario(width, height, seed, mode, tiles, connect)
+    for _ in range(memory_steps):
+        ca.update()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    ca.close()
+
+    result = {
+        "width": width,
+        "height": height,
+        "mode": mode,
+        "tiles": tiles,
+        "seed": seed,
+        "connect": connect,
+        "steps": steps,
+        "seconds": elapsed,
+        "steps_per_sec": steps / elapsed if elapsed else None,
+        "particles_per_sec": particles / elapsed if elapsed else None,
+        "mean_particles": particles / steps if steps else 0,
+        "peak_memory_bytes": peak,
+    }
+    if phases is not None:
+        result["phases"] = {name: {"count": count, "ms": ms} for name, (count, ms) in phases.items()}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless benchmark of the 2D cellular automaton")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[(128, 128), (256, 256)],
+                        help="world sizes as WIDTHxHEIGHT")
+    parser.add_argument("--modes", nargs="+", choices=UPDATE_MODES, default=UPDATE_MODES)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory-steps", type=int, default=5)
+    parser.add_argument("--tiles", type=int, default=1, help="worker processes for the margolus mode")
+    parser.add_argument("--stats", action="store_true", help="also time every part of update")
+    parser.add_argument("--connect", choices=["fill", "tunnel"], help="remove closed pockets from the cave")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    results = []
+    for width, height in args.sizes:
+        for mode in args.modes:
+            # The serial mode cannot be tiled, it always runs in one process
+            tiles = args.tiles if mode == "margolus" else 1
+            result = run_benchmark(width, height, args.steps, args.seed, mode, args.memory_steps, tiles,
+                                   args.stats, args.connect)
+            results.append(result)
+            print(f"{width}x{height} {mode} x{tiles}: {result['steps_per_sec']:.1f} steps/s, "
+                  f"{result['particles_per_sec']:.0f} particles/s, "
+                  f"peak {result['peak_memory_bytes'] / 2 ** 20:.1f} MiB")
+            if args.stats:
+                for name, phase in result["phases"].items():
+                    print(f"    {name:<12}{phase['count']:>10.1f}{phase['ms']:>9.2f} ms")
+
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
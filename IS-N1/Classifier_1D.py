@@ -0,0 +1,121 @@
+import csv
+import sys
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+
+from Automaton_1D import CellularAutomaton1D
+
+SHORT_PERIOD = 8  # periods up to generations // SHORT_PERIOD count as class 2
+FIELDS = ["rule", "seed", "transient", "period", "density", "entropy",
+          "compression", "damage", "damage_speed", "wolfram_class"]
+
+
+def getInitial(width, seed, base_seed=0):
+    # The same seed gives the same initial row for every rule, so runs are comparable and reproducible
+    rng = np.random.default_rng([base_seed, seed])
+    return rng.integers(0, 2, width)
+
+
+def runRule(rule, initial, generations):
+    ca = CellularAutomaton1D(rule, len(initial), generations)
+    ca.grid[0] = initial
+    ca.generate(detect_cycles=True)
+    return ca
+
+
+def rowEntropy(grid):
+    # Mean Shannon entropy of the 3-cell patterns in each row, scaled to 0-1
+    codes = 4 * np.roll(grid, 1, axis=1) + 2 * grid + np.roll(grid, -1, axis=1)
+    rows = np.arange(len(grid))[:, None]
+    counts = np.bincount((8 * rows + codes).ravel(), minlength=8 * len(grid)).reshape(-1, 8)
+    p = counts / grid.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.where(p > 0, p * np.log2(p), 0).sum(axis=1)
+    return entropy.mean() / 3
+
+
+def compressionRatio(grid):
+    # Compressed size of the packed diagram relative to its packed size, near 0 for ordered and near 1 for random
+    packed = np.packbits(grid.astype(np.uint8)).tobytes()
+    return len(zlib.compress(packed, 6)) / max(len(packed), 1)
+
+
+def damageSpreading(rule, initial, grid):
+    # Flip the middle cell and follow how far and how much the difference spreads
+    flipped = initial.copy()
+    flipped[len(initial) // 2] ^= 1
+    other = runRule(rule, flipped, len(grid)).grid
+    diff = grid != other
+
+    tail = diff[-max(1, len(diff) // 4):]
+    damage = tail.mean()
+
+    # Growth of the damaged region per generation, 1 means it spreads one cell per side per step
+    steps = min(len(diff) - 1, len(initial) // 2)
+    columns = np.nonzero(diff[steps])[0]
+    if steps == 0 or len(columns) == 0:
+        return damage, 0.0
+    spread = (columns.max() - columns.min()) / (2 * steps)
+    return damage, min(spread, 1.0)
+
+
+def guessClass(period, density, entropy, compression, damage_speed, generations):
+    # Rough Wolfram class from the metrics, not a proof of anything
+    if period == 1 and density in (0.0, 1.0):
+        return 1
+    # On a finite ring every rule cycles eventually, only a period short next to the run is periodic behaviour
+    if (period is not None and period <= generations // SHORT_PERIOD) or damage_speed < 0.1:
+        return 2
+    if compression > 0.8 and entropy > 0.8:
+        return 3
+    return 4
+
+
+def classifyRun(task):
+    rule, seed, width, generations, base_seed = task
+    initial = getInitial(width, seed, base_seed)
+    ca = runRule(rule, initial, generations)
+
+    # Metrics are taken on the second half of the run, after most transients
+    grid = ca.grid[generations // 2:]
+    density = float(grid[-1].mean())
+    entropy = float(rowEntropy(grid))
+    compression = float(compressionRatio(grid))
+    damage, damage_speed = damageSpreading(rule, initial, ca.grid)
+
+    return {
+        "rule": rule,
+        "seed": seed,
+        "transient": ca.transient,
+        "period": ca.period,
+        "density": density,
+        "entropy": entropy,
+        "compression": compression,
+        "damage": float(damage),
+        "damage_speed": float(damage_speed),
+        "wolfram_class": guessClass(ca.period, density, entropy, compression, damage_speed, generations),
+    }
+
+
+def classifyRules(rules=range(256), seeds=4, width=257, generations=256, base_seed=0, processes=None):
+    # Every (rule, seed) pair is one task, results come back in task order whatever the number of processes.
+    # The width is odd, on a power-of-two ring additive rules like 90 and 150 die out or cycle early
+    tasks = [(rule, seed, width, generations, base_seed) for rule in rules for seed in range(seeds)]
+    with Pool(processes) as pool:
+        return pool.map(classifyRun, tasks)
+
+
+def writeTable(results, path):
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == "__main__":
+    output = sys.argv[1] if len(sys.argv) > 1 else "classification.csv"
+    results = classifyRules()
+    writeTable(results, output)
+    print(f"Wrote {len(results)} runs to {output}")
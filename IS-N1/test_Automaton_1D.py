@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from Automaton_1D import CellularAutomaton1D, MemmapSink, PackedCellularAutomaton1D
+
+
+def referenceGrid(rule, width, generations):
+    # The original cell-by-cell loop, written against the rule number instead of a compiled table
+    grid = np.zeros((generations, width), dtype=int)
+    grid[0, width // 2] = 1
+    for i in range(1, generations):
+        for j in range(width):
+            left, center, right = grid[i - 1, j - 1], grid[i - 1, j], grid[i - 1, (j + 1) % width]
+            grid[i, j] = (rule >> (4 * left + 2 * center + right)) & 1
+    return grid
+
+
+def parseRows(rows):
+    return np.array([[cell == '#' for cell in row] for row in rows], dtype=int)
+
+
+@pytest.mark.parametrize("rule, rows", [
+    (30, [".....#.....",
+          "....###....",
+          "...##..#...",
+          "..##.####..",
+          ".##..#...#."]),
+    (90, [".....#.....",
+          "....#.#....",
+          "...#...#...",
+          "..#.#.#.#..",
+          ".#.......#."]),
+])
+def test_known_rows(rule, rows):
+    expected = parseRows(rows)
+    for vectorized in (False, True):
+        ca = CellularAutomaton1D(rule, expected.shape[1], len(expected))
+        assert np.array_equal(ca.generate(vectorized=vectorized), expected)
+
+
+@pytest.mark.parametrize("rule", range(256))
+def test_scalar_and_vectorized_match_reference(rule):
+    expected = referenceGrid(rule, 37, 30)
+    scalar = CellularAutomaton1D(rule, 37, 30)
+    vectorized = CellularAutomaton1D(rule, 37, 30)
+    assert np.array_equal(scalar.generate(vectorized=False), expected)
+    assert np.array_equal(vectorized.generate(), expected)
+
+
+@pytest.mark.parametrize("rule, radius, colors, totalistic", [
+    (1635, 1, 3, True),
+    (2 ** 31 + 12345, 2, 2, False),
+    (20, 2, 2, True),
+])
+def test_scalar_matches_vectorized_wider_rules(rule, radius, colors, totalistic):
+    scalar = CellularAutomaton1D(rule, 41, 30, radius=radius, colors=colors, totalistic=totalistic)
+    vectorized = CellularAutomaton1D(rule, 41, 30, radius=radius, colors=colors, totalistic=totalistic)
+    assert np.array_equal(scalar.generate(vectorized=False), vectorized.generate())
+
+
+def test_elementary_rule_table_matches_rule_bits():
+    # Digit i of the rule is the next state of neighbourhood code i, leftmost cell most significant
+    for rule in range(256):
+        assert CellularAutomaton1D(rule, 5, 2).rule_table.tolist() == [(rule >> i) & 1 for i in range(8)]
+
+
+@pytest.mark.parametrize("rule", [30, 90, 110, 184])
+def test_packed_matches_vectorized(rule):
+    # 130 cells spans three words, so the carries between words are covered
+    packed = PackedCellularAutomaton1D(rule, 130, 60)
+    packed.generate()
+    vectorized = CellularAutomaton1D(rule, 130, 60)
+    assert np.array_equal(packed.grid, vectorized.generate())
+    assert np.array_equal(list(packed.stream()), vectorized.grid)
+
+
+@pytest.mark.parametrize("rule", [4, 50, 90, 184])
+def test_streamed_cycle_matches_full_run(rule, tmp_path):
+    full = CellularAutomaton1D(rule, 40, 300)
+    full.generate()
+    streamed = CellularAutomaton1D(rule, 40, 300, sink=MemmapSink(tmp_path / "rows.bin", 40))
+    streamed.generate(detect_cycles=True)
+    assert streamed.period is not None
+    assert np.array_equal(streamed.sink.open(), full.grid)
@@ -0,0 +1,116 @@
+import gc
+
+import numpy as np
+import pytest
+from multiprocessing.shared_memory import SharedMemory
+
+from Automaton_2D import (BALLOON, DARK_SMOKE, ELEMENTS, EMPTY, FIRE, MOVE, NEW_LIFETIME, SAND, SWAP, WALL, WATER,
+                          WOOD, CellularAutomaton2D, Element, compile_elements, register_element, replay)
+
+
+def sandScene(**kwargs):
+    # Sand, water and wood never draw random bits in the block update, so every run of it is the same
+    ca = CellularAutomaton2D(101, 76, seed=3, mode="margolus", chunk_size=16, **kwargs)
+    ca.generate_cave(fill_ratio=0.35)
+    rng = np.random.default_rng(1)
+    for _ in range(1500):
+        x, y = rng.integers(1, 100), rng.integers(1, 75)
+        ca.add_element(int(x), int(y), [SAND, WATER, WOOD][rng.integers(3)])
+    return ca
+
+
+@pytest.mark.parametrize("tiles", [2, 3])
+def test_tiles_match_single_process(tiles):
+    single = sandScene()
+    with sandScene(tiles=tiles) as tiled:
+        for frame in range(60):
+            single.update()
+            tiled.update()
+            assert np.array_equal(tiled.elements, single.elements), frame
+            assert np.array_equal(tiled.water, single.water), frame
+            assert np.array_equal(tiled.changed, single.changed), frame
+            assert np.array_equal(tiled.quiet, single.quiet), frame
+
+
+def test_close_releases_tiles():
+    with sandScene(tiles=2) as ca:
+        names = [memory.name for memory in ca.shared]
+        workers = list(ca.workers)
+        ca.update()
+    assert ca.workers == [] and ca.shared == []
+    assert not any(worker.is_alive() for worker in workers)
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
+
+    # The planes are plain arrays again, the automaton keeps running in this process
+    assert ca.elements.base is None
+    ca.update()
+    ca.close()  # closing twice does nothing
+
+
+def test_collected_automaton_releases_tiles():
+    ca = sandScene(tiles=2)
+    names = [memory.name for memory in ca.shared]
+    release = ca.release
+    del ca
+    gc.collect()  # the bound kernels make a reference cycle
+    assert not release.alive
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
+
+
+def paintFrames(ca, frames, seed=3):
+    # The same strokes of every element, some cells at a time and some in bulk
+    rng = np.random.default_rng(seed)
+    for frame in range(frames):
+        element = [SAND, WATER, FIRE, WOOD, BALLOON, DARK_SMOKE][frame % 6]
+        for _ in range(5):
+            ca.add_element(int(rng.integers(0, ca.width)), int(rng.integers(0, ca.height)), element)
+        x, y = int(rng.integers(5, ca.width - 5)), int(rng.integers(5, ca.height - 5))
+        ca.paint_circle(x, y, 2, element)
+        ca.update()
+
+
+def assertSameRun(a, b):
+    assert a.frame == b.frame
+    for plane in ("elements", "water", "lifetime", "quiet"):
+        assert np.array_equal(getattr(a, plane), getattr(b, plane)), plane
+
+
+@pytest.mark.parametrize("mode, tiles", [("serial", 1), ("margolus", 1), ("margolus", 2)])
+def test_replay_reproduces_run(mode, tiles, tmp_path):
+    with CellularAutomaton2D(80, 60, seed=7, mode=mode, tiles=tiles) as ca:
+        ca.generate_cave(fill_ratio=0.3)
+        ca.start_recording()
+        paintFrames(ca, 60)
+        ca.save_replay(tmp_path / "run.npz")
+        with replay(tmp_path / "run.npz", tiles) as replayed:
+            assertSameRun(replayed, ca)
+
+
+@pytest.mark.parametrize("mode, tiles", [("serial", 1), ("margolus", 1), ("margolus", 2)])
+def test_checkpoint_resumes_run(mode, tiles, tmp_path):
+    with CellularAutomaton2D(80, 60, seed=7, mode=mode, tiles=tiles) as ca:
+        ca.generate_cave(fill_ratio=0.3)
+        paintFrames(ca, 30)
+        ca.save_checkpoint(tmp_path / "run.npz", background=False)
+        paintFrames(ca, 30, seed=4)
+        with CellularAutomaton2D.load_checkpoint(tmp_path / "run.npz", tiles) as resumed:
+            paintFrames(resumed, 30, seed=4)
+            assertSameRun(resumed, ca)
+
+
+def test_sand_tables_displace_only_water_below():
+    _, _, groups, _, _ = compile_elements(ELEMENTS)[SAND]
+    (_, down), (_, diagonal) = groups
+    assert down[EMPTY] == MOVE and down[WATER] == SWAP and down[WALL] != SWAP
+    assert diagonal[EMPTY] == MOVE and diagonal[WATER] != SWAP
+
+
+@pytest.mark.parametrize("lifetime", [(0, 10), (5, 4), (1, NEW_LIFETIME - 1)])
+def test_register_rejects_lifetimes_outside_the_plane(lifetime):
+    with pytest.raises(ValueError):
+        register_element(Element(200, "Mist", moves=[[(0, -1)]], lifetime=lifetime))
+    assert 200 not in ELEMENTS